@@ -16,3 +16,16 @@ EXPENSE_AMOUNT_REMARK = (
 )
 REVENUE_AMOUNT_REMARK = """The user provide the gross_amount. You should use the 
 tax rate to calculate the net_amount."""
+
+# Replies rendered from the rows a successful write stored, see `terminal_tools`
+EXPENSE_REPLY = (
+    'Added the expense "{description}" of {gross_amount} '
+    "(net {net_amount}) on {date}."
+)
+REVENUE_REPLY = (
+    'Added the revenue "{description}" of {gross_amount} '
+    "(net {net_amount}) on {date}."
+)
+CUSTOMER_REPLY = "Added {first_name} {last_name} ({company}) as a customer."
+EXPENSES_REPLY = "Added {count} expenses."
+REVENUES_REPLY = "Added {count} revenue entries."
@@ -0,0 +1,91 @@
+"""Service configurations"""
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# * Webhook dispatcher
+DISPATCHER_WORKERS = int(os.getenv("DISPATCHER_WORKERS", "4"))
+DISPATCHER_MAX_QUEUE_SIZE = int(os.getenv("DISPATCHER_MAX_QUEUE_SIZE", "100"))
+# Agent runs awaiting OpenAI at the same time on the event loop
+DISPATCHER_MAX_CONCURRENCY = int(os.getenv("DISPATCHER_MAX_CONCURRENCY", "200"))
+DISPATCHER_SHUTDOWN_TIMEOUT = float(os.getenv("DISPATCHER_SHUTDOWN_TIMEOUT", "30"))
+DISPATCHER_DEBOUNCE_SECONDS = float(os.getenv("DISPATCHER_DEBOUNCE_SECONDS", "1.5"))
+DISPATCHER_MAX_DEBOUNCE_SECONDS = float(
+    os.getenv("DISPATCHER_MAX_DEBOUNCE_SECONDS", "5")
+)
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "5"))
+
+# * Durable inbox
+INBOX_LEASE_SECONDS = int(os.getenv("INBOX_LEASE_SECONDS", "300"))
+INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "5"))
+INBOX_MAX_PENDING = int(os.getenv("INBOX_MAX_PENDING", "1000"))
+INBOX_POLL_INTERVAL = float(os.getenv("INBOX_POLL_INTERVAL", "1.0"))
+INBOX_RETRY_BACKOFF = float(os.getenv("INBOX_RETRY_BACKOFF", "5"))
+INBOX_RETENTION_SECONDS = int(os.getenv("INBOX_RETENTION_SECONDS", "604800"))
+
+# * Message de-duplication
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "86400"))
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", "10000"))
+DEDUP_PERSISTENT = os.getenv("DEDUP_PERSISTENT", "true").lower() == "true"
+
+# * Graph API HTTP client
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+
+# * Media downloads
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Larger media is spooled to a temporary file instead of memory
+MEDIA_SPOOL_MAX_MEMORY = int(os.getenv("MEDIA_SPOOL_MAX_MEMORY", str(1024 * 1024)))
+# WhatsApp caps audio messages at 16 MB
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# * Transcription cache
+TRANSCRIPTION_CACHE_TTL_SECONDS = int(
+    os.getenv("TRANSCRIPTION_CACHE_TTL_SECONDS", str(30 * 24 * 60 * 60))
+)
+TRANSCRIPTION_CACHE_MAX_SIZE = int(os.getenv("TRANSCRIPTION_CACHE_MAX_SIZE", "1000"))
+TRANSCRIPTION_CACHE_MAX_ROWS = int(os.getenv("TRANSCRIPTION_CACHE_MAX_ROWS", "50000"))
+# Voice notes longer than 1.5 chunks are split and transcribed in parallel
+TRANSCRIPTION_CHUNK_SECONDS = float(os.getenv("TRANSCRIPTION_CHUNK_SECONDS", "30"))
+TRANSCRIPTION_CHUNK_WORKERS = int(os.getenv("TRANSCRIPTION_CHUNK_WORKERS", "4"))
+
+# * Outbound messages
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "20"))
+OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", "20"))
+OUTBOUND_SENDERS = int(os.getenv("OUTBOUND_SENDERS", "4"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+OUTBOUND_RETRY_BACKOFF = float(os.getenv("OUTBOUND_RETRY_BACKOFF", "1"))
+
+# * User directory
+# How often users are reloaded from the `employee` table
+USER_DIRECTORY_REFRESH_SECONDS = float(
+    os.getenv("USER_DIRECTORY_REFRESH_SECONDS", "60")
+)
+
+# * Agent runs
+# Independent tool calls of one model response that run at the same time
+TOOL_CALL_WORKERS = int(os.getenv("TOOL_CALL_WORKERS", "4"))
+# Prompt tokens a step may send; older tool results are dropped to fit
+AGENT_TOKEN_BUDGET = int(os.getenv("AGENT_TOKEN_BUDGET", "6000"))
+# Tool results of earlier steps are truncated to this many tokens
+TOOL_RESULT_MAX_TOKENS = int(os.getenv("TOOL_RESULT_MAX_TOKENS", "300"))
+
+# * Queries
+# Rows of a query result sent to the model; larger results are summarized
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "50"))
+# Compiled statements kept per query shape, i.e. a query without its values
+QUERY_PLAN_CACHE_SIZE = int(os.getenv("QUERY_PLAN_CACHE_SIZE", "256"))
+# Query results kept in memory, invalidated by writes to their table
+QUERY_CACHE_MAX_SIZE = int(os.getenv("QUERY_CACHE_MAX_SIZE", "512"))
+
+# * Routing
+# Messages whose similarity to an agent's routing examples reaches the threshold,
+# and beats every other agent by the margin, skip the routing LLM call
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.15"))
+ROUTER_MIN_MARGIN = float(os.getenv("ROUTER_MIN_MARGIN", "0.1"))
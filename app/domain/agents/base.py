@@ -2,20 +2,26 @@
 
 import colorama
 from colorama import Fore
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from pydantic import BaseModel
 
 from dotenv import load_dotenv
 from langsmith import traceable
 from langsmith.wrappers import wrap_openai
 
-from .utils import parse_function_args, run_tool_from_response
+from .prompt import PromptBuilder, record_usage
+from .utils import arun_tool_calls, run_tool_calls
 from ..tools.base import Tool, ToolResult
+from ..tools.registry import ToolRegistry
+from ..tools.results import encode_value
 from ...configs.logging_config import get_logger
 from ...configs.model_configs import MODEL, MAX_STEPS, COLOR
+from ...infrastructure.metrics import REGISTRY
 
 logger = get_logger(__name__)
 
+terminal_finishes = REGISTRY.counter("agent_terminal_tool_finishes")
+
 load_dotenv()
 
 
@@ -37,7 +43,8 @@ You will receive feedback based on the outcomes of each tool's task execution or
 explanations for any tasks that couldn't be completed. This feedback loop is crucial 
 for addressing and resolving any issues by strategically deploying the available tools.
 
-Return only one tool call at a time.
+You may return several tool calls at once when they don't depend on each other's
+results. Call the report_tool only once you have seen the results of your work.
 
 {context}
 """
@@ -49,10 +56,26 @@ class StepResult(BaseModel):
     success: bool
 
 
+class AgentRun:
+    """State of a single run of an agent. Each run gets its own, so an agent can
+    serve several conversations at the same time and keeps nothing once a run
+    is over."""
+
+    __slots__ = ("messages", "steps", "prompt_length", "step_tokens")
+
+    def __init__(self, messages: list) -> None:
+        self.messages = messages
+        self.steps = 0
+        # Messages after the prompt are the history of the run's steps
+        self.prompt_length = len(messages)
+        # Prompt tokens sent by each step
+        self.step_tokens: list[int] = []
+
+
 class OpenAIAgent:
     def __init__(
         self,
-        tools: list[Tool],
+        tools: list[Tool] | ToolRegistry,
         client: OpenAI = wrap_openai(OpenAI()),
         system_message: str = SYSTEM_MESSAGE,
         model_name: str = MODEL,
@@ -61,104 +84,138 @@ class OpenAIAgent:
         examples: list[dict] = None,
         context: str = None,
         user_context: str = None,
+        terminal_tools: dict[str, str] = None,
+        async_client: AsyncOpenAI = wrap_openai(AsyncOpenAI()),
     ):
-        self.tools = tools
+        self.tools = tools if isinstance(tools, ToolRegistry) else ToolRegistry(tools)
         self.client = client
+        self.async_client = async_client
         self.model_name = model_name
         self.system_message = system_message
-        self.step_history = []
         self.max_steps = max_steps
         self.verbose = verbose
         self.examples = examples or []
         self.context = context or ""
         self.user_context = user_context
+        # Tool name -> reply template, see `terminal_reply`
+        self.terminal_tools = terminal_tools or {}
+        self.prompt = PromptBuilder(model_name)
 
     def to_console(self, tag: str, message: str, color: str = COLOR):
         if self.verbose:
             color_prefix = Fore.__dict__[color.upper()]
             print(color_prefix + f"{tag}: {message}{colorama.Style.RESET_ALL}")
 
+    def start_run(self, user_input: str, context: str = None) -> AgentRun:
+        """Start a run. The agent's `context`, e.g. table schemas, is part of
+        the system message; the user context and `context` of this run are
+        volatile and go with the user message, after the cacheable prefix"""
+        volatile_context = "\n".join(filter(None, (self.user_context, context)))
+
+        self.to_console("START", f"Starting agent with input: {user_input}")
+
+        return AgentRun(
+            self.prompt.build(
+                user_input,
+                system=self.system_message,
+                schema=self.context,
+                examples=self.examples,
+                context=volatile_context,
+            )
+        )
+
+    def log_step(self, step_result: StepResult) -> None:
+        if step_result.event == "error":
+            self.to_console(step_result.event, step_result.content, "red")
+        else:
+            self.to_console(step_result.event, step_result.content, "yellow")
+
     @traceable
     def run(self, user_input: str, context: str = None):
-        openai_tools = [tool.openai_tool_schema for tool in self.tools]
-        system_message = self.system_message.format(context=context)
+        openai_tools = self.tools.schemas
+        run = self.start_run(user_input, context)
+        step_result = None
 
-        if self.user_context:
-            context = (
-                f"{self.user_context}\n{context}" if context else self.user_context
-            )
-        if context:
-            user_input = f"{context}\n---\n\nUser Message: {user_input}"
+        while run.steps < self.max_steps:
+            step_result = self.run_step(run, openai_tools)
 
-        self.to_console("START", f"Starting agent with input: {user_input}")
+            if step_result.event == "finish":
+                break
+            self.log_step(step_result)
+            run.steps += 1
 
-        self.step_history = [
-            {"role": "system", "content": self.system_message},
-            *self.examples,
-            {"role": "user", "content": user_input},
-        ]
+        self.to_console("Final Result", step_result.content, COLOR)
+        self.to_console("Prompt tokens per step", run.step_tokens, COLOR)
+        return step_result.content
 
+    @traceable
+    async def arun(self, user_input: str, context: str = None):
+        """Async counterpart of `run`, waits for the model without blocking a
+        thread"""
+        openai_tools = self.tools.schemas
+        run = self.start_run(user_input, context)
         step_result = None
-        i = 0
 
-        while i < self.max_steps:
-            step_result = self.run_step(self.step_history, openai_tools)
+        while run.steps < self.max_steps:
+            step_result = await self.arun_step(run, openai_tools)
 
             if step_result.event == "finish":
                 break
-            if step_result.event == "error":
-                self.to_console(step_result.event, step_result.content, "red")
-            else:
-                self.to_console(step_result.event, step_result.content, "yellow")
-            i += 1
+            self.log_step(step_result)
+            run.steps += 1
 
         self.to_console("Final Result", step_result.content, COLOR)
+        self.to_console("Prompt tokens per step", run.step_tokens, COLOR)
         return step_result.content
 
-    def run_step(self, messages: list[dict], tools):
+    def compact(self, run: AgentRun) -> None:
+        """Fit the history of `run` into the token budget before the next step"""
+        tokens = self.prompt.compact(run.messages, run.prompt_length)
+        run.step_tokens.append(tokens)
+        logger.debug("Step %s sends %s prompt tokens", run.steps + 1, tokens)
+
+    def run_step(self, run: AgentRun, tools):
+        """Plan and execute the next step of `run`"""
 
         # Plan next step
+        self.compact(run)
         response = self.client.chat.completions.create(
-            model=self.model_name, messages=messages, tools=tools
+            model=self.model_name, messages=run.messages, tools=tools
         )
+        record_usage(response)
 
-        # Check for multiple tool calls
-        if (
-            response.choices[0].message.tool_calls
-            and len(response.choices[0].message.tool_calls) > 1
-        ):
-            logger.warning("Multiple tool calls detected, requesting single tool call")
-            # Find the original user input from the messages history
-            original_user_message = next(
-                (
-                    msg
-                    for msg in reversed(messages)
-                    if hasattr(msg, "role") and msg.role == "user"
-                ),
-                None,
-            )
-            original_user_input_content = (
-                original_user_message.content
-                if original_user_message and hasattr(original_user_message, "content")
-                else ""
-            )
+        step_result = self.record_response(run, response)
+        if step_result:
+            return step_result
+
+        # Execute tool calls
+        tool_calls = response.choices[0].message.tool_calls
+        tool_results = run_tool_calls(tool_calls, tools=self.tools)
+        return self.record_tool_results(run, tool_calls, tool_results)
 
-            # Create a new, clean message history for the retry
-            new_messages = [
-                {"role": "system", "content": self.system_message},
-                *self.examples,
-                {
-                    "role": "user",
-                    "content": original_user_input_content,
-                },  # Use the retrieved original user input
-                {
-                    "role": "user",
-                    "content": "Error: Please return only one tool call at a time.",
-                },
-            ]
-            return self.run_step(messages=new_messages, tools=tools)
-
-        self.step_history.append(response.choices[0].message)
+    async def arun_step(self, run: AgentRun, tools):
+        """Async counterpart of `run_step`"""
+
+        # Plan next step
+        self.compact(run)
+        response = await self.async_client.chat.completions.create(
+            model=self.model_name, messages=run.messages, tools=tools
+        )
+        record_usage(response)
+
+        step_result = self.record_response(run, response)
+        if step_result:
+            return step_result
+
+        # Execute tool calls
+        tool_calls = response.choices[0].message.tool_calls
+        tool_results = await arun_tool_calls(tool_calls, tools=self.tools)
+        return self.record_tool_results(run, tool_calls, tool_results)
+
+    def record_response(self, run: AgentRun, response) -> StepResult | None:
+        """Add the model's response to `run`. Returns an error step if it didn't
+        call a tool"""
+        run.messages.append(response.choices[0].message)
 
         # Check if tool call is present
         if not response.choices[0].message.tool_calls:
@@ -170,42 +227,100 @@ class OpenAIAgent:
                 success=False,
             )
 
-        tool_name = response.choices[0].message.tool_calls[0].function.name
-        tool_kwargs = parse_function_args(response)
-        logger.debug("Tool call detected - Name: %s, Args: %s", tool_name, tool_kwargs)
-
-        # Execute tool call
-        self.to_console(
-            "Tool Call", f"Name: {tool_name}\nArgs: {tool_kwargs}", "magenta"
-        )
-        tool_result = run_tool_from_response(response, tools=self.tools)
-        logger.debug("Tool execution result: %s", tool_result)
-        tool_result_msg = self.tool_call_message(response, tool_result)
-        self.step_history.append(tool_result_msg)
-
-        if tool_name == "report_tool":
-            try:
-                step_result = StepResult(
-                    event="finish", content=tool_result.content, success=True
-                )
-            except:
-                logger.error("Tool result: %s", tool_result)
-                raise ValueError("Report tool failed to run")
-            return step_result
-
-        elif tool_result.success:
-            step_result = StepResult(
-                event="tool_result", content=tool_result.content, success=True
+        for tool_call in response.choices[0].message.tool_calls:
+            tool_name = tool_call.function.name
+            tool_kwargs = tool_call.function.arguments
+            logger.debug(
+                "Tool call detected - Name: %s, Args: %s", tool_name, tool_kwargs
             )
-        else:
-            step_result = StepResult(
-                event="error", content=tool_result.content, success=False
+            self.to_console(
+                "Tool Call", f"Name: {tool_name}\nArgs: {tool_kwargs}", "magenta"
             )
+        return None
+
+    def record_tool_results(
+        self, run: AgentRun, tool_calls, tool_results: list[ToolResult]
+    ) -> StepResult:
+        """Add the results of the step's tool calls to `run`, in the order of
+        the calls. The run finishes when a terminal tool or `report_tool` was
+        called and every other call of the step succeeded; a report only if
+        no other call of the step returned results the model hasn't seen"""
+        logger.debug("Tool execution results: %s", tool_results)
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            run.messages.append(self.tool_call_message(tool_call, tool_result))
+
+        reports = [
+            tool_result
+            for tool_call, tool_result in zip(tool_calls, tool_results)
+            if tool_call.function.name == "report_tool"
+        ]
+        others = [
+            (tool_call, tool_result)
+            for tool_call, tool_result in zip(tool_calls, tool_results)
+            if tool_call.function.name != "report_tool"
+        ]
+        if (
+            reports
+            and all(tool_result.success for _, tool_result in others)
+            and not any(self.needs_review(tool_call) for tool_call, _ in others)
+        ):
+            return StepResult(event="finish", content=reports[-1].content, success=True)
 
-        return step_result
+        if len(others) == 1:
+            content = others[0][1].content
+        else:
+            content = "\n".join(
+                f"{tool_call.function.name}: {tool_result.content}"
+                for tool_call, tool_result in others
+            )
+        if all(tool_result.success for _, tool_result in others):
+            reply = self.terminal_reply(tool_calls, tool_results)
+            if reply:
+                terminal_finishes.inc()
+                return StepResult(event="finish", content=reply, success=True)
+            return StepResult(event="tool_result", content=content, success=True)
+        return StepResult(event="error", content=content, success=False)
+
+    def needs_review(self, tool_call) -> bool:
+        """Whether the model has to see the result of `tool_call` before its
+        report can be final, e.g. a query the report should be based on. The
+        results of writes and terminal tools only confirm what the report
+        already states"""
+        name = tool_call.function.name
+        if name in self.terminal_tools or name not in self.tools:
+            return False
+        return getattr(self.tools.get(name), "read_only", False)
+
+    def terminal_reply(self, tool_calls, tool_results: list[ToolResult]) -> str | None:
+        """The reply to the user rendered from the templates of the terminal
+        tools among the successful `tool_calls`, which saves the model round trip
+        to `report_tool`. Templates are formatted with the `data` the tool
+        stored, not the call's arguments, which the tool may have corrected;
+        `None` if no terminal tool was called or a value is missing"""
+        replies = []
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            template = self.terminal_tools.get(tool_call.function.name)
+            if template is None:
+                continue
+            if tool_result.data is None:
+                logger.warning(
+                    "Terminal tool %s returned no data to render its reply",
+                    tool_call.function.name,
+                )
+                return None
+            values = {
+                key: encode_value(value) for key, value in tool_result.data.items()
+            }
+            try:
+                replies.append(template.format_map(values))
+            except (KeyError, IndexError, ValueError) as e:
+                logger.warning(
+                    "Could not render reply of %s: %s", tool_call.function.name, e
+                )
+                return None
+        return "\n".join(replies) or None
 
-    def tool_call_message(self, response, tool_result: ToolResult):
-        tool_call = response.choices[0].message.tool_calls[0]
+    def tool_call_message(self, tool_call, tool_result: ToolResult):
         return {
             "tool_call_id": tool_call.id,
             "role": "tool",
@@ -0,0 +1,172 @@
+"""Local classifier that routes messages without calling the LLM
+
+The agents' `routing_utterances` and the user messages of their
+`routing_example`s are embedded as TF-IDF vectors over hashed words and word
+prefixes, and averaged into one centroid per agent.
+A new message goes to the agent of the most similar centroid if the similarity
+is high enough and clearly ahead of every other agent; otherwise the routing
+LLM decides. `main` reports the hit rate and precision of a few thresholds.
+"""
+
+import re
+import zlib
+
+from typing import Iterable
+
+import numpy as np
+
+from ...configs.logging_config import get_logger
+from ...configs.service_configs import ROUTER_CONFIDENCE_THRESHOLD, ROUTER_MIN_MARGIN
+from ...infrastructure.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+N_FEATURES = 2**14
+# Crude stemming, e.g. "customers" and "customer" share "custo"
+PREFIX_LENGTH = 5
+WORD = re.compile(r"[^\W\d_]+")
+
+predictions = REGISTRY.counter("router_fast_path_predictions")
+fallbacks = REGISTRY.counter("router_llm_fallbacks")
+router_confidence = REGISTRY.histogram(
+    "router_confidence", buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+)
+
+
+def fast_path_hit_rate() -> float:
+    total = predictions.value + fallbacks.value
+    return round(predictions.value / total, 4) if total else 0.0
+
+
+REGISTRY.gauge("router_fast_path_hit_rate", callback=fast_path_hit_rate)
+
+
+def _hash(token: str) -> int:
+    # crc32 instead of `hash`, which differs between processes
+    return zlib.crc32(token.encode()) % N_FEATURES
+
+
+def features(text: str) -> list[int]:
+    """Hashed words and word prefixes of `text`. Digits are ignored, so amounts
+    and dates don't influence the route"""
+    indices = []
+    for word in WORD.findall(text.lower()):
+        indices.append(_hash(word))
+        if len(word) > PREFIX_LENGTH:
+            indices.append(_hash(f"^{word[:PREFIX_LENGTH]}"))
+    return indices
+
+
+def user_utterances(agent) -> Iterable[str]:
+    """Messages the classifier learns `agent` from"""
+    yield from agent.routing_utterances
+    for message in agent.routing_example:
+        if message.get("role") == "user" and message.get("content"):
+            yield message["content"]
+
+
+class RoutingClassifier:
+    """Nearest-centroid classifier over the agents' routing examples"""
+
+    def __init__(
+        self,
+        utterances: list[str],
+        labels: list[str],
+        threshold: float = ROUTER_CONFIDENCE_THRESHOLD,
+        min_margin: float = ROUTER_MIN_MARGIN,
+    ) -> None:
+        self.threshold = threshold
+        self.min_margin = min_margin
+        self.names = sorted(set(labels))
+        label_ids = np.array([self.names.index(label) for label in labels])
+        counts = np.stack([self._counts(text) for text in utterances])
+        document_frequency = np.count_nonzero(counts, axis=0)
+        self.idf = np.log((1 + len(utterances)) / (1 + document_frequency)) + 1
+        vectors = self._normalize(counts * self.idf)
+        centroids = np.zeros((len(self.names), N_FEATURES), dtype=vectors.dtype)
+        np.add.at(centroids, label_ids, vectors)
+        self.centroids = self._normalize(centroids)
+        REGISTRY.gauge("router_confidence_threshold").set(threshold)
+        REGISTRY.gauge("router_min_margin").set(min_margin)
+        logger.info(
+            "Built routing classifier from %s examples of %s agents "
+            "(threshold %s, margin %s)",
+            len(utterances),
+            len(self.names),
+            threshold,
+            min_margin,
+        )
+
+    @classmethod
+    def from_agents(cls, agents: Iterable, **kwargs) -> "RoutingClassifier | None":
+        """Build a classifier from the routing utterances of agents that can be
+        called without arguments. Returns `None` if fewer than two agents have
+        examples"""
+        utterances, labels = [], []
+        for agent in agents:
+            if any(f.is_required() for f in agent.arg_model.model_fields.values()):
+                continue
+            for text in user_utterances(agent):
+                utterances.append(text)
+                labels.append(agent.name)
+        if len(set(labels)) < 2:
+            return None
+        return cls(utterances, labels, **kwargs)
+
+    @staticmethod
+    def _counts(text: str) -> np.ndarray:
+        counts = np.zeros(N_FEATURES, dtype=np.float32)
+        np.add.at(counts, features(text), 1)
+        return np.log1p(counts)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def scores(self, text: str) -> dict[str, float]:
+        """Cosine similarity between `text` and the examples of each agent"""
+        vector = self._normalize(self._counts(text) * self.idf)
+        return dict(zip(self.names, (self.centroids @ vector).tolist()))
+
+    def predict(self, text: str) -> tuple[str | None, float]:
+        """The agent for `text` and the confidence, or `None` if the LLM should
+        decide"""
+        ranked = sorted(self.scores(text).items(), key=lambda item: -item[1])
+        (name, confidence), (_, runner_up) = ranked[0], ranked[1]
+        router_confidence.observe(confidence)
+        if confidence >= self.threshold and confidence - runner_up >= self.min_margin:
+            predictions.inc()
+            return name, confidence
+        fallbacks.inc()
+        return None, confidence
+
+
+def main() -> None:
+    """Leave-one-out evaluation of the demo agent's routing utterances"""
+    from .demo_agent import demo_agent
+
+    agents = list(demo_agent.tools)
+    samples = [
+        (text, agent.name) for agent in agents for text in user_utterances(agent)
+    ]
+    for threshold in (0.1, 0.15, 0.2, 0.25):
+        hits = correct = 0
+        for i, (text, name) in enumerate(samples):
+            rest = samples[:i] + samples[i + 1 :]
+            classifier = RoutingClassifier(
+                [t for t, _ in rest], [n for _, n in rest], threshold=threshold
+            )
+            predicted, _ = classifier.predict(text)
+            hits += predicted is not None
+            correct += predicted == name
+        logger.info(
+            "Threshold %.2f: hit rate %.2f, precision %.2f",
+            threshold,
+            hits / len(samples),
+            correct / hits if hits else 0,
+        )
+
+
+if __name__ == "__main__":
+    main()
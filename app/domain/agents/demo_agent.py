@@ -3,17 +3,22 @@
 from dotenv import load_dotenv
 
 from ...configs.model_configs import (
+    CUSTOMER_REPLY,
     EXPENSE_AMOUNT_REMARK,
+    EXPENSE_REPLY,
+    EXPENSES_REPLY,
     REVENUE_AMOUNT_REMARK,
+    REVENUE_REPLY,
+    REVENUES_REPLY,
     TAX_REMARK,
 )
 
 from .routing import RoutingAgent
 from .task import TaskAgent
 
-from ..utils import generate_query_context
+from ..utils import generate_context, today_context
 
-from ..tools.add import add_entry_to_table
+from ..tools.add import add_entries_to_table, add_entry_to_table, bulk_model
 from ..tools.base import Tool
 from ..tools.query import QueryConfig, query_data_function
 
@@ -38,6 +43,24 @@ add_revenue_tool = Tool(
     validate_missing=True,
     exclude_keys=["id", "customer"],
 )
+# Many rows in one call, step and transaction, e.g. "log these 8 receipts"
+add_expenses_tool = Tool(
+    name="add_expenses_tool",
+    description="Useful for adding several expenses to database at once",
+    function=add_entries_to_table(Expense),
+    model=bulk_model(Expense),
+    # Missing values are reported per row
+    validate_missing=False,
+    resources=("expense",),
+)
+add_revenues_tool = Tool(
+    name="add_revenues_tool",
+    description="Useful for adding several revenue entries to database at once",
+    function=add_entries_to_table(Revenue),
+    model=bulk_model(Revenue, exclude_keys=("id", "customer")),
+    validate_missing=False,
+    resources=("revenue", "customer"),
+)
 add_customer_tool = Tool(
     name="add_customer_tool",
     description="Useful for adding a customer to the database",
@@ -50,40 +73,124 @@ query_data_tool = Tool(
     description="Useful for performing queries on a database table",
     model=QueryConfig,
     function=query_data_function,
+    # Most fields of a query are optional, the query tool validates them itself
+    validate_missing=False,
+    read_only=True,
+    resource_arg="table_name",
 )
 
 query_task_agent = TaskAgent(
     name="query_agent",
     description="An agent that can perform queries on multiple data sources",
-    create_user_context=lambda: generate_query_context(Expense, Revenue, Customer),
+    create_context=lambda: generate_context(Expense, Revenue, Customer),
+    create_user_context=today_context,
     tools=[query_data_tool],
+    routing_utterances=[
+        "What are my expenses to date?",
+        "How much did I spend last month?",
+        "Show me all customers",
+        "What was my total revenue this year?",
+        "List all expenses over 100 euros",
+        "Which customer brought in the most revenue?",
+        "How much tax did I pay in March?",
+        "Give me a summary of this week's sales",
+        "Show me my expenses for May",
+        "How many customers do I have?",
+        "What did I earn from Acme last quarter?",
+        "Total spending on fuel this year?",
+        "List my last 10 sales",
+        "What is my profit this month?",
+    ],
 )
 add_expense_agent = TaskAgent(
     name="add_expense_agent",
     description="An agent that can add an expense to the database",
-    create_user_context=lambda: generate_query_context(Expense)
-    + f"\nRemarks: {TAX_REMARK} {EXPENSE_AMOUNT_REMARK}",
-    tools=[add_expense_tool],
+    create_context=lambda: generate_context(Expense)
+    + f"\nRemarks: {TAX_REMARK} {EXPENSE_AMOUNT_REMARK} "
+    + "Add several expenses in one call of add_expenses_tool.",
+    create_user_context=today_context,
+    tools=[add_expense_tool, add_expenses_tool],
+    terminal_tools={
+        "add_expense_tool": EXPENSE_REPLY,
+        "add_expenses_tool": EXPENSES_REPLY,
+    },
+    routing_utterances=[
+        "I bought office paper for 12 euros",
+        "Spent 45 on fuel yesterday",
+        "Paid 120 for the internet bill",
+        "bought a new laptop for 899",
+        "Lunch with the team cost 63.50",
+        "I paid 30 euros for parking today",
+        "Expense: printer ink 25",
+        "Purchased cleaning supplies for 18",
+        "Bought coffee beans for 14 euros",
+        "Train ticket to Hamburg, 79 euros",
+        "I spent 200 on marketing flyers",
+        "Rent for the office, 950",
+        "Paid the accountant 300",
+        "Got new tires for the van for 420",
+    ],
 )
 add_revenue_agent = TaskAgent(
     name="add_revenue_agent",
     description="An agent that can add a revenue entry to the database",
-    create_user_context=lambda: (
-        generate_query_context(Revenue, Customer)
+    create_context=lambda: (
+        generate_context(Revenue, Customer)
         + f"\nRemarks: {TAX_REMARK} {REVENUE_AMOUNT_REMARK}\n"
         + "IMPORTANT: Before adding revenue:\n"
         + "1. If a customer is mentioned, check if they exist using query_data_tool\n"
         + "2. If customer doesn't exist and you have their details, create them using add_customer_tool\n"
-        + "3. Add the revenue with add_revenue_tool (using the customer_id from step 1 or 2)\n"
+        + "3. Add the revenue with add_revenue_tool (using the customer_id from step 1 or 2), "
+        + "or all entries at once with add_revenues_tool if there are several\n"
         + "4. If no customer is mentioned, proceed directly to adding revenue"
     ),
-    tools=[query_data_tool, add_customer_tool, add_revenue_tool],
+    create_user_context=today_context,
+    tools=[query_data_tool, add_customer_tool, add_revenue_tool, add_revenues_tool],
+    # Adding the customer is only an intermediate step here
+    terminal_tools={
+        "add_revenue_tool": REVENUE_REPLY,
+        "add_revenues_tool": REVENUES_REPLY,
+    },
+    routing_utterances=[
+        "I sold 3 chairs for 240 to Miller GmbH",
+        "Sold a website to Acme for 1500",
+        "Received 800 from Jane Doe for consulting",
+        "Invoice paid by Smith & Co, 2300 euros",
+        "Made 90 from selling coffee at the market",
+        "Client Brown paid me 450 for the design work",
+        "Sold two tickets for 60",
+        "Earned 1200 for the catering job at Baker Ltd",
+        "Sold 5 bottles of wine for 75",
+        "Acme bought 10 licenses from me for 990",
+        "Customer paid 250 for the repair",
+        "I got paid 600 by Green Energy for the workshop",
+        "Revenue: 1300 from the Miller project",
+        "Sold my old printer to Tom for 80",
+    ],
 )
 add_customer_agent = TaskAgent(
     name="add_customer_agent",
     description="An agent that can add a customer to the database",
-    create_user_context=lambda: generate_query_context(Customer),
+    create_context=lambda: generate_context(Customer),
+    create_user_context=today_context,
     tools=[add_customer_tool],
+    terminal_tools={"add_customer_tool": CUSTOMER_REPLY},
+    routing_utterances=[
+        "Add a new customer",
+        "Create a customer: Acme Corp, 12 Main Street, Berlin",
+        "New client John Smith, phone 555 1234",
+        "Please register Baker Ltd as a customer",
+        "Save the contact details of our new client Maria Lopez",
+        "Add customer Green Energy in Munich, zip 80331",
+        "I have a new customer called Blue Sky Studios",
+        "Store a new client with the address Hauptstrasse 5, Hamburg",
+        "Add Peter Brown as a customer, Lindenweg 3, 10115 Berlin",
+        "Create a new customer record for Sunrise Bakery",
+        "Register the client Alpine Tours in Vienna",
+        "New customer: Lisa Meyer, Gartenstr. 12, Cologne",
+        "Add the company Nordwind AG to my customers",
+        "Put Carla Rossi into the customer list, phone 0151 2345678",
+    ],
 )
 
 demo_agent = RoutingAgent(
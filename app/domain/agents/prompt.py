@@ -0,0 +1,236 @@
+"""Prompt assembly with a stable, cacheable prefix
+
+OpenAI caches the longest prefix a request shares with recent requests, so the
+messages are ordered from the most to the least stable segment: the system
+instructions, the table schemas, the few-shot examples and finally the
+volatile context, e.g. today's date, which goes into the user message. Every
+segment is counted locally with `tiktoken`, and the usage of each response
+reports how many prompt tokens were served from the cache.
+
+Within a run, the history is compacted before every step: tool results of
+earlier steps are truncated, and dropped oldest first if the step would exceed
+the token budget. The results of the latest step are always sent in full.
+"""
+
+import re
+
+from functools import lru_cache
+
+from ...configs.logging_config import get_logger
+from ...configs.model_configs import MODEL
+from ...configs.service_configs import AGENT_TOKEN_BUDGET, TOOL_RESULT_MAX_TOKENS
+from ...infrastructure.metrics import REGISTRY
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = get_logger(__name__)
+
+SEGMENTS = ("system", "schema", "examples", "context")
+# Rough size of a token, used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+OMITTED = "[Result omitted to save tokens]"
+TRUNCATED = re.compile(r"\[\.\.\. \d+ more tokens truncated\]$")
+
+segment_tokens = {
+    segment: REGISTRY.histogram(f"prompt_{segment}_tokens", buckets=TOKEN_BUCKETS)
+    for segment in SEGMENTS
+}
+prompt_tokens = REGISTRY.counter("llm_prompt_tokens")
+cached_tokens = REGISTRY.counter("llm_cached_prompt_tokens")
+completion_tokens = REGISTRY.counter("llm_completion_tokens")
+step_tokens = REGISTRY.histogram("agent_step_prompt_tokens", buckets=TOKEN_BUCKETS)
+compacted_tokens = REGISTRY.counter("agent_compacted_tokens")
+
+
+def cached_token_ratio() -> float:
+    if not prompt_tokens.value:
+        return 0.0
+    return round(cached_tokens.value / prompt_tokens.value, 4)
+
+
+REGISTRY.gauge("llm_cached_prompt_token_ratio", callback=cached_token_ratio)
+
+
+@lru_cache(maxsize=None)
+def encoding_for(model_name: str):
+    """The tokenizer of `model_name`, `None` if `tiktoken` or its encoding files
+    aren't available"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning("Could not load tokenizer, estimating tokens: %s", e)
+        return None
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str, model_name: str = MODEL) -> int:
+    """Tokens of `text`. Cached, as most segments are the same on every call"""
+    if not text:
+        return 0
+    encoding = encoding_for(model_name)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, model_name: str = MODEL) -> str:
+    """The first `max_tokens` tokens of `text`, marked as truncated"""
+    encoding = encoding_for(model_name)
+    if encoding is None:
+        head, rest = (
+            text[: max_tokens * CHARS_PER_TOKEN],
+            text[max_tokens * CHARS_PER_TOKEN :],
+        )
+        dropped = count_tokens(rest, model_name)
+    else:
+        tokens = encoding.encode(text)
+        head, dropped = encoding.decode(tokens[:max_tokens]), len(tokens) - max_tokens
+    return f"{head}[... {dropped} more tokens truncated]"
+
+
+def _field(item, key: str):
+    return item.get(key) if isinstance(item, dict) else getattr(item, key, None)
+
+
+def message_text(message) -> str:
+    """The text of a message the model reads, including its tool calls. Works
+    for dicts and the message objects returned by the OpenAI client"""
+    parts = [_field(message, "content") or ""]
+    for tool_call in _field(message, "tool_calls") or []:
+        function = _field(tool_call, "function")
+        parts.append(_field(function, "name") or "")
+        parts.append(_field(function, "arguments") or "")
+    return "".join(parts)
+
+
+class PromptBuilder:
+    """Builds the messages of a request in a fixed segment order, so requests
+    of the same agent share everything up to the volatile context"""
+
+    def __init__(
+        self,
+        model_name: str = MODEL,
+        token_budget: int = AGENT_TOKEN_BUDGET,
+        tool_result_tokens: int = TOOL_RESULT_MAX_TOKENS,
+    ) -> None:
+        self.model_name = model_name
+        self.token_budget = token_budget
+        self.tool_result_tokens = tool_result_tokens
+
+    def build(
+        self,
+        user_input: str,
+        system: str,
+        schema: str = "",
+        examples: list[dict] | None = None,
+        context: str = "",
+        **variables,
+    ) -> list[dict]:
+        """Messages for `user_input`. `system` is formatted with `variables`
+        and the `schema` as `context`; the volatile `context` precedes the
+        user message"""
+        system_message = system.format(**variables, context=schema)
+        examples = examples or []
+        if context:
+            user_message = f"{context}\n---\n\nUser Message: {user_input}"
+        else:
+            user_message = user_input
+
+        self.count(
+            system=system.format(**variables, context=""),
+            schema=schema,
+            examples="".join(message_text(message) for message in examples),
+            context=context,
+        )
+        return [
+            {"role": "system", "content": system_message},
+            *examples,
+            {"role": "user", "content": user_message},
+        ]
+
+    def count(self, **segments: str) -> dict[str, int]:
+        """Count and record the tokens of each segment"""
+        tokens = {
+            segment: count_tokens(text, self.model_name)
+            for segment, text in segments.items()
+        }
+        for segment, count in tokens.items():
+            segment_tokens[segment].observe(count)
+        logger.debug("Prompt tokens by segment: %s", tokens)
+        return tokens
+
+    def message_tokens(self, message) -> int:
+        return count_tokens(message_text(message), self.model_name)
+
+    def compact(self, messages: list, start: int) -> int:
+        """Shorten the tool results of earlier steps in `messages[start:]` in
+        place, and return the prompt tokens of the step about to be sent"""
+        assistant = [
+            i
+            for i in range(start, len(messages))
+            if _field(messages[i], "role") == "assistant"
+        ]
+        # Results of the latest step follow the last assistant message
+        older = [
+            i
+            for i in range(start, assistant[-1] if assistant else start)
+            if _field(messages[i], "role") == "tool"
+        ]
+        for i in older:
+            content = messages[i]["content"]
+            if content == OMITTED or TRUNCATED.search(content):
+                continue
+            tokens = count_tokens(content, self.model_name)
+            if tokens > self.tool_result_tokens:
+                content = truncate_tokens(
+                    content, self.tool_result_tokens, self.model_name
+                )
+                messages[i] = {**messages[i], "content": content}
+                compacted_tokens.inc(tokens - count_tokens(content, self.model_name))
+
+        total = sum(self.message_tokens(message) for message in messages)
+        for i in older:
+            if total <= self.token_budget:
+                break
+            if messages[i]["content"] == OMITTED:
+                continue
+            saved = self.message_tokens(messages[i]) - count_tokens(OMITTED)
+            messages[i] = {**messages[i], "content": OMITTED}
+            compacted_tokens.inc(saved)
+            total -= saved
+        if total > self.token_budget:
+            logger.warning(
+                "Step needs %s prompt tokens, over the budget of %s",
+                total,
+                self.token_budget,
+            )
+        step_tokens.observe(total)
+        return total
+
+
+def record_usage(response) -> None:
+    """Record the tokens a response used, and how many of the prompt tokens
+    were served from OpenAI's prompt cache"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    prompt_tokens.inc(usage.prompt_tokens)
+    cached_tokens.inc(cached)
+    completion_tokens.inc(usage.completion_tokens)
+    logger.debug(
+        "Usage: %s prompt tokens (%s cached), %s completion tokens",
+        usage.prompt_tokens,
+        cached,
+        usage.completion_tokens,
+    )
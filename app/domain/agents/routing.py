@@ -5,11 +5,15 @@ import colorama
 from langsmith import traceable
 from langsmith.wrappers import wrap_openai
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
+from .classifier import RoutingClassifier
+from .prompt import PromptBuilder, record_usage
 from .task import TaskAgent
 from .utils import parse_function_args
 
+from ..tools.registry import ToolRegistry
+
 from ...configs.model_configs import MODEL, MAX_STEPS, COLOR
 
 SYSTEM_MESSAGE = """
@@ -59,18 +63,20 @@ class RoutingAgent:
         prompt_extra: dict = None,
         examples: list[dict] = None,
         context: str = None,
+        async_client: AsyncOpenAI = wrap_openai(AsyncOpenAI()),
     ):
-        self.tools = tools
+        self.tools = ToolRegistry(tools)
         self.client = client
+        self.async_client = async_client
         self.model_name = model_name
         self.system_message = system_message
-        self.memory = []
-        self.step_history = []
         self.max_steps = max_steps
         self.verbose = verbose
         self.prompt_extra = prompt_extra or PROMPT_EXTRA
         self.examples = self.load_examples(examples)
         self.context = context or ""
+        self.classifier = RoutingClassifier.from_agents(self.tools)
+        self.prompt = PromptBuilder(model_name)
 
     def load_examples(self, examples: list[dict] = None):
         examples = examples or []
@@ -78,47 +84,78 @@ class RoutingAgent:
             examples.extend(agent.routing_example)
         return examples
 
-    @traceable
-    def run(self, user_input: str, employee_id: int = None, **kwargs):
+    def classify(self, user_input: str) -> str | None:
+        """Agent to route to without asking the LLM, if the classifier is
+        confident enough"""
+        if self.classifier is None:
+            return None
+        tool_name, confidence = self.classifier.predict(user_input)
+        if tool_name:
+            self.to_console("FAST PATH", f"{tool_name} ({confidence:.2f})")
+        return tool_name
+
+    def build_messages(self, user_input: str, **kwargs) -> list[dict]:
         context = kwargs.get("context") or self.context
-        if context:
-            user_input_with_context = f"{context}\n---\n\nUser Message: {user_input}"
-        else:
-            user_input_with_context = user_input
-        self.to_console(
-            "START", f"Starting Routing Agent with input:\n'''{user_input_with_context}"
-        )
-        partial_variables = {**self.prompt_extra, "context": context}
-        system_message = self.system_message.format(**partial_variables)
-
+        self.to_console("START", f"Starting Routing Agent with input:\n'''{user_input}")
         # TODO get user roles
-        messages = [
-            {"role": "system", "content": system_message},
-            *self.examples,
-            {"role": "user", "content": user_input},
-        ]
-
-        tools = [tool.openai_tool_schema for tool in self.tools]
-
-        response = self.client.chat.completions.create(
-            model=self.model_name, messages=messages, tools=tools
+        return self.prompt.build(
+            user_input,
+            system=self.system_message,
+            examples=self.examples,
+            context=context,
+            **self.prompt_extra,
         )
-        self.step_history.append(response.choices[0].message)
+
+    def route(self, response) -> tuple[str, dict]:
         self.to_console("RESPONSE", response.choices[0].message.content, color="blue")
         tools_kwargs = parse_function_args(response)
         tool_name = response.choices[0].message.tool_calls[0].function.name
         self.to_console("Tool name:", tool_name)
         self.to_console("Tool args:", tools_kwargs)
+        return tool_name, tools_kwargs
+
+    @traceable
+    def run(self, user_input: str, employee_id: int = None, **kwargs):
+        tool_name, tools_kwargs = self.classify(user_input), {}
+        if tool_name is None:
+            messages = self.build_messages(user_input, **kwargs)
+            response = self.client.chat.completions.create(
+                model=self.model_name, messages=messages, tools=self.tools.schemas
+            )
+            record_usage(response)
+            tool_name, tools_kwargs = self.route(response)
 
         agent = self.prepare_agent(tool_name, tools_kwargs)
         return agent.run(user_input)
 
+    @traceable
+    async def arun(self, user_input: str, employee_id: int = None, **kwargs):
+        """Async counterpart of `run`"""
+        tool_name, tools_kwargs = self.classify(user_input), {}
+        if tool_name is None:
+            messages = self.build_messages(user_input, **kwargs)
+            response = await self.async_client.chat.completions.create(
+                model=self.model_name, messages=messages, tools=self.tools.schemas
+            )
+            record_usage(response)
+            tool_name, tools_kwargs = self.route(response)
+
+        agent = await self.aprepare_agent(tool_name, tools_kwargs)
+        return await agent.arun(user_input)
+
     def prepare_agent(self, tool_name, tool_kwargs):
-        for agent in self.tools:
-            if agent.name == tool_name:
-                input_kwargs = agent.arg_model.model_validate(tool_kwargs)
-                return agent.load_agent(**input_kwargs.model_dump())
-        raise ValueError(f"Agent {tool_name} not found")
+        if tool_name not in self.tools:
+            raise ValueError(f"Agent {tool_name} not found")
+        agent = self.tools.get(tool_name)
+        input_kwargs = agent.arg_model.model_validate(tool_kwargs)
+        return agent.load_agent(**input_kwargs.model_dump())
+
+    async def aprepare_agent(self, tool_name, tool_kwargs):
+        if tool_name not in self.tools:
+            raise ValueError(f"Agent {tool_name} not found")
+        agent = self.tools.get(tool_name)
+        input_kwargs = agent.arg_model.model_validate(tool_kwargs)
+        return await agent.aload_agent(**input_kwargs.model_dump())
 
     def to_console(self, tag: str, message: str, color: str = COLOR):
         if self.verbose:
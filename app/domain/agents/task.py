@@ -1,13 +1,16 @@
 """Tool wrapper for OpenAI subagents"""
 
+import asyncio
+
 from typing import Type, Callable, Optional
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
 
 from .base import OpenAIAgent
 
 from ..tools.base import Tool
 from ..tools.convert import convert_to_openai_tool
+from ..tools.registry import ToolRegistry
 from ..tools.report_tool import report_tool
 
 SYSTEM_MESSAGE = """You are tasked with completing specific objectives and must report the outcomes. At your disposal, you have a variety of tools, each specialized in performing a distinct type of task.
@@ -45,7 +48,7 @@ Use the information provided by the user to deduce the correct tool arguments.
 
 Before using a tool, think about the arguments, and explain each input argument used in the tool.
 
-Return only one tool call at a time! Explain your thoughts!
+You may return several tool calls at once when they don't depend on each other's results, but call the report_tool only after you have seen the results. Explain your thoughts!
 
 {context}
 """
@@ -66,7 +69,28 @@ class TaskAgent(BaseModel):
     tools: list[Tool]
     examples: list[dict] = None
     routing_example: list[dict] = Field(default_factory=list)
-    model_config = ConfigDict(arbitrary_types_allowed=True)
+    # Messages the local router learns this agent from. Unlike
+    # `routing_example`, they are never sent to the routing LLM
+    routing_utterances: list[str] = Field(default_factory=list)
+    # Tool name -> reply template. A successful call of one of these tools
+    # finishes the run with the rendered reply instead of a `report_tool` step
+    terminal_tools: dict[str, str] = Field(default_factory=dict)
+    # Agents are shared by all requests, per-request state lives in `AgentRun`
+    model_config = ConfigDict(arbitrary_types_allowed=True, frozen=True)
+
+    _schema: dict | None = PrivateAttr(default=None)
+    _registry: ToolRegistry | None = PrivateAttr(default=None)
+
+    def model_post_init(self, __context) -> None:
+        if report_tool not in self.tools:
+            self.tools.append(report_tool)
+
+    @property
+    def registry(self) -> ToolRegistry:
+        """The static tools of the agent, compiled on first use"""
+        if self._registry is None:
+            self._registry = ToolRegistry(self.tools)
+        return self._registry
 
     def load_agent(self, **kwargs) -> OpenAIAgent:
         input_kwargs = self.arg_model(**kwargs)
@@ -82,22 +106,30 @@ class TaskAgent(BaseModel):
         else:
             user_context = None
 
+        tools = self.registry
         if self.tool_loader:
-            self.tools.extend(self.tool_loader(**kwargs))
-
-        if report_tool not in self.tools:
-            self.tools.append(report_tool)
+            tools = tools.with_tools(self.tool_loader(**kwargs))
 
         return OpenAIAgent(
-            tools=self.tools,
+            tools=tools,
             context=context,
             user_context=user_context,
             system_message=self.system_message,
             examples=self.examples,
+            terminal_tools=self.terminal_tools,
         )
 
+    async def aload_agent(self, **kwargs) -> OpenAIAgent:
+        """`load_agent` in a worker thread, as context builders may query the
+        database"""
+        return await asyncio.to_thread(self.load_agent, **kwargs)
+
     @property
-    def openai_tool_schema(self):
-        return convert_to_openai_tool(
-            self.arg_model, name=self.name, description=self.description
-        )
+    def openai_tool_schema(self) -> dict:
+        """The agent as an OpenAI tool, converted on first access. The returned
+        dict is shared and must not be modified."""
+        if self._schema is None:
+            self._schema = convert_to_openai_tool(
+                self.arg_model, name=self.name, description=self.description
+            )
+        return self._schema
@@ -1,13 +1,30 @@
 """Agent utilities"""
 
+import asyncio
+import contextvars
 import json
 
-from ..tools.base import Tool
+from concurrent.futures import ThreadPoolExecutor
+
+from ..tools.base import Tool, ToolResult
+from ..tools.registry import ToolRegistry
 
 from ...configs.logging_config import get_logger
+from ...configs.service_configs import TOOL_CALL_WORKERS
+from ...infrastructure.metrics import REGISTRY
 
 logger = get_logger(__name__)
 
+# Shared by all agent runs, so concurrent runs can't exceed the bound
+_pool = ThreadPoolExecutor(max_workers=TOOL_CALL_WORKERS, thread_name_prefix="tool")
+
+tool_calls_per_step = REGISTRY.histogram(
+    "agent_tool_calls_per_step", buckets=(1, 2, 3, 4, 8)
+)
+tool_call_waves_per_step = REGISTRY.histogram(
+    "agent_tool_call_waves_per_step", buckets=(1, 2, 3, 4, 8)
+)
+
 
 def parse_function_args(response):
     message = response.choices[0].message
@@ -16,18 +33,89 @@ def parse_function_args(response):
     return json.loads(message.tool_calls[0].function.arguments)
 
 
-def get_tool_from_response(response, tools: list[Tool]):
-    tool_name = response.choices[0].message.tool_calls[0].function.name
-    for t in tools:
-        if t.name == tool_name:
-            return t
-    raise ValueError(f"Tool {tool_name} not found in tools list.")
+def parse_tool_calls(tool_calls, tools: ToolRegistry) -> list[tuple[Tool, dict]]:
+    """The tools and arguments of the `tool_calls` of a model response"""
+    return [
+        (tools.get(call.function.name), json.loads(call.function.arguments))
+        for call in tool_calls
+    ]
+
+
+def conflicts(first: tuple[Tool, dict], second: tuple[Tool, dict]) -> bool:
+    """Whether two tool calls must run one after the other"""
+    (first_tool, first_kwargs), (second_tool, second_kwargs) = first, second
+    if first_tool.read_only and second_tool.read_only:
+        return False
+    first_resources = first_tool.resources_for(first_kwargs)
+    second_resources = second_tool.resources_for(second_kwargs)
+    if first_resources is None or second_resources is None:
+        return True
+    return not first_resources.isdisjoint(second_resources)
+
+
+def tool_call_waves(calls: list[tuple[Tool, dict]]) -> list[list[int]]:
+    """Group the indices of `calls` into waves whose calls can run concurrently.
+    Each call goes into the wave after the last earlier call it conflicts with,
+    so dependent calls keep the order the model returned them in"""
+    levels = []
+    for i, call in enumerate(calls):
+        levels.append(
+            max(
+                (levels[j] + 1 for j in range(i) if conflicts(calls[j], call)),
+                default=0,
+            )
+        )
+    waves = [[] for _ in range(max(levels, default=-1) + 1)]
+    for i, level in enumerate(levels):
+        waves[level].append(i)
+    tool_calls_per_step.observe(len(calls))
+    tool_call_waves_per_step.observe(len(waves))
+    return waves
 
 
-def run_tool_from_response(response, tools: list[Tool]):
-    tool = get_tool_from_response(response, tools)
-    tool_kwargs = parse_function_args(response)
+def run_tool_call(call: tuple[Tool, dict]) -> ToolResult:
+    tool, tool_kwargs = call
     logger.debug("Executing tool %s with args: %s", tool.name, tool_kwargs)
     result = tool.run(**tool_kwargs)
     logger.debug("Tool execution completed with result: %s", result)
     return result
+
+
+def run_tool_calls(tool_calls, tools: ToolRegistry) -> list[ToolResult]:
+    """Run the `tool_calls` of a model response, independent calls in parallel.
+    Results are in the order of the calls"""
+    calls = parse_tool_calls(tool_calls, tools)
+    results = [None] * len(calls)
+    for wave in tool_call_waves(calls):
+        if len(wave) == 1:
+            results[wave[0]] = run_tool_call(calls[wave[0]])
+            continue
+        # A context per call, so `record_writes` sees the calls of the workers
+        futures = [
+            _pool.submit(contextvars.copy_context().run, run_tool_call, calls[i])
+            for i in wave
+        ]
+        for i, future in zip(wave, futures):
+            results[i] = future.result()
+    return results
+
+
+async def arun_tool_calls(tool_calls, tools: ToolRegistry) -> list[ToolResult]:
+    """Async counterpart of `run_tool_calls`"""
+    calls = parse_tool_calls(tool_calls, tools)
+    limit = asyncio.Semaphore(TOOL_CALL_WORKERS)
+
+    async def arun_tool_call(call: tuple[Tool, dict]) -> ToolResult:
+        tool, tool_kwargs = call
+        async with limit:
+            logger.debug("Executing tool %s with args: %s", tool.name, tool_kwargs)
+            result = await tool.arun(**tool_kwargs)
+        logger.debug("Tool execution completed with result: %s", result)
+        return result
+
+    results = [None] * len(calls)
+    for wave in tool_call_waves(calls):
+        wave_results = await asyncio.gather(*(arun_tool_call(calls[i]) for i in wave))
+        for i, result in zip(wave, wave_results):
+            results[i] = result
+    return results
@@ -35,3 +35,11 @@ class TranscriptionError(Exception):
     def __init__(self, detail: str, *args: object) -> None:
         super().__init__(*args)
         self.detail = detail
+
+
+class QueueFullError(Exception):
+    max_size: int
+
+    def __init__(self, max_size: int, *args: object) -> None:
+        super().__init__(*args)
+        self.max_size = max_size
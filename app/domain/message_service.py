@@ -1,20 +1,28 @@
 """WhatsApp domain-specific functions"""
 
+import asyncio
 import os
+import time
 
 
+from tempfile import SpooledTemporaryFile
 from typing import BinaryIO
 
-import json
-import requests
+import httpx
 
 from dotenv import load_dotenv
 from openai import OpenAI
 
 from .agents.demo_agent import demo_agent
+from .transcription import transcribe_chunked
 from ..configs.logging_config import get_logger
-from ..schema import Audio, User
-
+from ..configs.service_configs import MEDIA_MAX_BYTES, MEDIA_SPOOL_MAX_MEMORY
+from ..infrastructure.http_client import GraphAPIClient
+from ..infrastructure.outbound import OutboundScheduler, Priority
+from ..persistance.models import InboxJob
+from ..persistance.transcripts import TranscriptionCache
+from ..persistance.users import UserDirectory
+from ..schema import Audio, Message, User
 
 logger = get_logger(__name__)
 
@@ -22,82 +30,92 @@ load_dotenv()
 
 WHATSAPP_API_KEY = os.getenv("WHATSAPP_API_KEY")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
-ALLOWED_USERS_LIST_STR = os.getenv("ALLOWED_USERS_LIST", "")
-
-
-def parse_allowed_users(users_string: str) -> list[dict]:
-    """Parses a delimited string of users into a list of dictionaries."""
-    users = []
-    if not users_string:
-        return users
-    user_entries = users_string.split(";")
-    for user_entry in user_entries:
-        try:
-            id_str, phone, first_name, last_name, role = user_entry.split(",")
-            users.append(
-                {
-                    "id": int(id_str),
-                    "phone": phone,
-                    "first_name": first_name,
-                    "last_name": last_name,
-                    "role": role,
-                }
-            )
-        except ValueError as e:
-            logger.error(f"Skipping invalid user entry: {user_entry}. Error: {e}")
-            continue
-    return users
-
-
-ALLOWED_USERS = parse_allowed_users(ALLOWED_USERS_LIST_STR)
 
 llm = OpenAI()
+graph_api = GraphAPIClient(WHATSAPP_API_KEY)
+# The scheduler retries on its own without blocking a sender thread
+outbound = OutboundScheduler(GraphAPIClient(WHATSAPP_API_KEY, max_retries=0))
+transcription_cache = TranscriptionCache()
+users = UserDirectory()
+
+MESSAGES_URL = f"/v22.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
 
 
-def transcribe_audio_file(audio_file: BinaryIO | None) -> str:
+def transcribe_audio_file(
+    audio_file: BinaryIO | None, filename: str | None = None
+) -> str:
     if not audio_file:
         return "No audio file provided"
     try:
         transcription = llm.audio.transcriptions.create(
-            file=audio_file, model="whisper-1", response_format="text"
+            # Whisper detects the format from the file name
+            file=(filename, audio_file) if filename else audio_file,
+            model="whisper-1",
+            response_format="text",
         )
         return transcription
     except Exception as e:
         raise ValueError("Error transcribing audio") from e
 
 
+def media_filename(file_id: str, mime_type: str) -> str:
+    file_extension = mime_type.split("/")[-1].split(";")[0]
+    return f"{file_id}.{file_extension}"
+
+
 def transcribe_audio(audio: Audio) -> str:
-    file_path = download_file_from_facebook(audio.id, "audio", audio.mime_type)
-    with open(file_path, "rb") as audio_binary:
-        transcription = transcribe_audio_file(audio_binary)
-    try:
-        os.remove(file_path)
-    except Exception as e:
-        logger.warning("Failed to delete file: %s", e)
+    transcription = transcription_cache.get(audio.sha256)
+    if transcription is not None:
+        logger.info("Reusing transcription of audio %s", audio.sha256)
+        return transcription
+    start = time.monotonic()
+    with download_file_from_facebook(audio.id, "audio", audio.mime_type) as buffer:
+        size_bytes = buffer.seek(0, os.SEEK_END)
+        buffer.seek(0)
+        transcription = transcribe_chunked(
+            buffer, media_filename(audio.id, audio.mime_type), transcribe_audio_file
+        )
+    transcription_cache.put(
+        audio.sha256, transcription, size_bytes, time.monotonic() - start
+    )
     return transcription
 
 
 def download_file_from_facebook(
     file_id: str, file_type: str, mime_type: str
-) -> str | None:
+) -> SpooledTemporaryFile:
+    """Download a media file into a buffer that stays in memory up to
+    `MEDIA_SPOOL_MAX_MEMORY` bytes and rolls over to an anonymous temporary file
+    beyond that. The caller owns the buffer and should close it.
+
+    Raises:
+        ValueError: The file could not be downloaded or exceeds `MEDIA_MAX_BYTES`
+    """
+    if file_type not in ("image", "audio"):
+        raise ValueError(f"Unsupported media type: {file_type}")
     # Retrieve file URL to then submit a second GET request to download
-    url = f"https://graph.facebook.com/v19.0/{file_id}"
-    headers = {"Authorization": f"Bearer {WHATSAPP_API_KEY}"}
-    response = requests.get(url, headers=headers)
+    response = graph_api.get(f"/v19.0/{file_id}")
 
     if response.status_code == 200:
         download_url = response.json().get("url")
 
-        response = requests.get(download_url, headers=headers)
+        buffer = SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_MEMORY)
+        try:
+            response = graph_api.download(
+                download_url, buffer, max_bytes=MEDIA_MAX_BYTES
+            )
+        except Exception:
+            buffer.close()
+            raise
 
         if response.status_code == 200:
-            file_extension = mime_type.split("/")[-1].split(";")[0]
-            file_path = f"{file_id}.{file_extension}"
-            with open(file_path, "wb") as file:
-                file.write(response.content)
-            if file_type == "image" or file_type == "audio":
-                return file_path
+            logger.info(
+                "Downloaded %s (%s, %s bytes)", file_id, mime_type, buffer.tell()
+            )
+            buffer.seek(0)
+            return buffer
 
+        buffer.close()
         raise ValueError(
             f"Failed to download file. Status code: {response.status_code}"
         )
@@ -107,22 +125,13 @@ def download_file_from_facebook(
 
 
 def authenticate_user_by_phone_number(phone_number: str) -> User | None:
-    """Authenticates a user by their phone number against the ALLOWED_USERS list."""
-    # ALLOWED_USERS is now populated from the environment variable
-    for user_data in ALLOWED_USERS:
-        if user_data["phone"] == phone_number:
-            return User(**user_data)
-    return None
+    """Authenticates a user by their phone number against the user directory."""
+    return users.get(phone_number)
 
 
-def send_whatsapp_message(to, message, template=True) -> dict:
-    url = f"https://graph.facebook.com/v22.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": "Bearer " + WHATSAPP_API_KEY,
-        "Content-Type": "application/json",
-    }
+def whatsapp_message_payload(to, message, template=True) -> dict:
     if not template:
-        data = {
+        return {
             "messaging_product": "whatsapp",
             "preview_url": False,
             "recipient_type": "individual",
@@ -130,18 +139,22 @@ def send_whatsapp_message(to, message, template=True) -> dict:
             "type": "text",
             "text": {"body": message},
         }
-    else:
-        data = {
-            "messaging_product": "whatsapp",
-            "to": to,
-            "type": "template",
-            "template": {"name": "hello_world", "language": {"code": "en_US"}},
-        }
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "template",
+        "template": {"name": "hello_world", "language": {"code": "en_US"}},
+    }
+
+
+def send_whatsapp_message(to, message, template=True) -> dict:
+    """Send a message right away, bypassing the outbound scheduler"""
+    data = whatsapp_message_payload(to, message, template)
 
     logger.info("Attempting to send message to WhatsApp API.")
 
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = graph_api.post(MESSAGES_URL, json=data)
         logger.info("Received response from WhatsApp API.")
         logger.info("Status Code: %s", response.status_code)
         logger.info("Response Body: %s", response.text)
@@ -149,25 +162,104 @@ def send_whatsapp_message(to, message, template=True) -> dict:
         response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
 
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error("Error sending message to WhatsApp API: %s", e)
         # Depending on desired behavior, you might want to re-raise or return an error indicator
         raise  # Re-raise the exception for now to make it visible
 
 
+def queue_whatsapp_message(
+    to, message, template=True, priority: Priority = Priority.INTERACTIVE
+) -> None:
+    """Hand a message to the rate-limited outbound scheduler"""
+    outbound.enqueue(
+        WHATSAPP_PHONE_NUMBER_ID,
+        MESSAGES_URL,
+        whatsapp_message_payload(to, message, template),
+        priority=priority,
+    )
+
+
 def respond_and_send_message(user_message: str, user: User) -> None:
     agent = demo_agent
     response = agent.run(user_message, user.id)
-    send_whatsapp_message(user.phone, response, template=False)
+    queue_whatsapp_message(user.phone, response, template=False)
     logger.info(
-        "Sent message to user %s %s (%s)", user.first_name, user.last_name, user.phone
+        "Queued message to user %s %s (%s)", user.first_name, user.last_name, user.phone
     )
     logger.info("Message: %s", response)
 
 
+async def arespond_and_send_message(user_message: str, user: User) -> None:
+    """Async counterpart of `respond_and_send_message`"""
+    response = await demo_agent.arun(user_message, user.id)
+    queue_whatsapp_message(user.phone, response, template=False)
+    logger.info(
+        "Queued message to user %s %s (%s)", user.first_name, user.last_name, user.phone
+    )
+    logger.info("Message: %s", response)
+
+
+def extract_user_message(message: Message) -> str | None:
+    """Text of a message, transcribing voice notes"""
+    if message.type == "audio" and message.audio:
+        return transcribe_audio(message.audio)
+    if message.text:
+        return message.text.body
+    return None
+
+
+def messages_from_inbox_jobs(
+    jobs: list[InboxJob],
+) -> tuple[list[Message], User | None]:
+    """Messages of `jobs` in the order they were sent and their sender"""
+    messages = sorted(
+        (Message.model_validate_json(job.payload) for job in jobs),
+        key=lambda message: int(message.timestamp),
+    )
+    user = authenticate_user_by_phone_number(messages[0].from_)
+    if not user:
+        logger.warning("Skipping %s inbox jobs: user not authorized", len(jobs))
+    return messages, user
+
+
+def process_inbox_jobs(jobs: list[InboxJob]) -> None:
+    """Answer messages accepted by the webhook and stored in the inbox. `jobs`
+    are consecutive messages of one user, e.g. "bought paper", "12 euros",
+    "yesterday", and are answered with a single agent run."""
+    messages, user = messages_from_inbox_jobs(jobs)
+    if not user:
+        return
+    user_messages = [
+        text for text in (extract_user_message(m) for m in messages) if text
+    ]
+    if not user_messages:
+        logger.info("Inbox jobs have no content to answer")
+        return
+    respond_and_send_message("\n".join(user_messages), user)
+
+
+async def aprocess_inbox_jobs(jobs: list[InboxJob]) -> None:
+    """Async counterpart of `process_inbox_jobs`. Voice notes are transcribed
+    in worker threads, the agent runs on the event loop."""
+    messages, user = messages_from_inbox_jobs(jobs)
+    if not user:
+        return
+    texts = await asyncio.gather(
+        *(asyncio.to_thread(extract_user_message, m) for m in messages)
+    )
+    user_messages = [text for text in texts if text]
+    if not user_messages:
+        logger.info("Inbox jobs have no content to answer")
+        return
+    await arespond_and_send_message("\n".join(user_messages), user)
+
+
 def main() -> None:
     user = authenticate_user_by_phone_number("15857039796")
+    outbound.start()
     respond_and_send_message("What are my expenses to date?", user=user)
+    outbound.stop()
 
 
 if __name__ == "__main__":
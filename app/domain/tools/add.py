@@ -1,33 +1,156 @@
 """Tool for adding data to the database"""
 
-from typing import Callable, Type
+from typing import Callable, Optional, Type
 
+from pydantic import BaseModel, Field, ValidationError, create_model
+from sqlalchemy import insert
 from sqlmodel import Session, SQLModel
 
+from .base import ToolResult
+
 from ...configs.logging_config import get_logger
+from ...infrastructure.metrics import REGISTRY
 
 from ...persistance import db
 from ...persistance.models import Expense
+from ...persistance.query_cache import bump_table_version
 
 logger = get_logger(__name__)
 
+rows_per_insert = REGISTRY.histogram(
+    "db_rows_per_insert", buckets=(1, 2, 5, 10, 20, 50, 100)
+)
+
 
-def add_row_to_table(model_instance: SQLModel) -> str:
+def add_row_to_table(model_instance: SQLModel) -> ToolResult:
     try:
         with Session(db.engine) as session:
             session.add(model_instance)
+            bump_table_version(session, model_instance.__tablename__)
             session.commit()
             session.refresh(model_instance)
-        return f"Successfully added {model_instance} to the table"
+        return ToolResult(
+            content=f"Successfully added {model_instance} to the table",
+            success=True,
+            data=model_instance.model_dump(),
+        )
     except Exception as e:
         logger.error("Error adding row to table: %s", str(e))
         raise
 
 
+def base_model(sql_model: Type[SQLModel]) -> Type[SQLModel]:
+    """The model without a table that `sql_model` extends, e.g. `ExpenseBase`
+    of `Expense`, or `sql_model` itself. Only models without a table run
+    validators that set attributes, like computing a missing gross amount"""
+    for cls in sql_model.__mro__[1:]:
+        if (
+            issubclass(cls, SQLModel)
+            and cls is not SQLModel
+            and not cls.model_config.get("table")
+        ):
+            return cls
+    return sql_model
+
+
+def validate_row(sql_model: Type[SQLModel], data: dict) -> SQLModel:
+    """`data` as a row of `sql_model`, validated by its model without a table
+
+    Raises:
+        ValidationError: `data` is not a valid row
+    """
+    row = base_model(sql_model).model_validate(data)
+    return sql_model.model_validate(row.model_dump())
+
+
+def validate_rows(
+    sql_model: Type[SQLModel], rows: list[dict]
+) -> tuple[list[SQLModel], list[str]]:
+    """Validate every row, returning the instances and one error per invalid
+    row, numbered from 1 like the user would count them"""
+    instances, errors = [], []
+    for number, row in enumerate(rows, start=1):
+        # Fields the model left out are sent as null, let their defaults apply
+        row = {key: value for key, value in row.items() if value is not None}
+        try:
+            instances.append(validate_row(sql_model, row))
+        except ValidationError as e:
+            problems = "; ".join(
+                f"{'.'.join(str(part) for part in error['loc']) or 'row'}: {error['msg']}"
+                for error in e.errors()
+            )
+            errors.append(f"Row {number}: {problems}")
+        except (ValueError, AttributeError, TypeError) as e:
+            # Raised by validators, e.g. arithmetic on a value of a wrong type
+            errors.append(f"Row {number}: {e}")
+    return instances, errors
+
+
+def add_rows_to_table(sql_model: Type[SQLModel], rows: list[dict]) -> ToolResult:
+    """Add all `rows` in one transaction, or none of them if any row is invalid.
+    Rows are inserted with a single executemany statement"""
+    if not rows:
+        return ToolResult(content="No rows to add", success=False)
+    instances, errors = validate_rows(sql_model, rows)
+    if errors:
+        return ToolResult(
+            content=f"Added none of the {len(rows)} rows, fix these and retry:\n"
+            + "\n".join(errors),
+            success=False,
+        )
+
+    table = sql_model.__table__
+    values = [
+        instance.model_dump(include=set(table.columns.keys()), exclude={"id"})
+        for instance in instances
+    ]
+    try:
+        with Session(db.engine) as session:
+            session.execute(insert(table), values)
+            bump_table_version(session, table.name)
+            session.commit()
+    except Exception as e:
+        logger.error("Error adding rows to table: %s", str(e))
+        raise
+    rows_per_insert.observe(len(values))
+    return ToolResult(
+        content=f"Successfully added {len(values)} rows to the {table.name} table",
+        success=True,
+        data={"count": len(values), "table": table.name},
+    )
+
+
 def add_entry_to_table(sql_model: Type[SQLModel]) -> Callable:
     # return a Callable that takes a SQLModel instance and adds it to the table
-    return lambda **data: add_row_to_table(
-        model_instance=sql_model.model_validate(data)
+    return lambda **data: add_row_to_table(model_instance=validate_row(sql_model, data))
+
+
+def add_entries_to_table(sql_model: Type[SQLModel]) -> Callable:
+    # return a Callable that adds a list of rows to the table at once
+    return lambda rows=(), **_: add_rows_to_table(sql_model, list(rows))
+
+
+def bulk_model(
+    sql_model: Type[SQLModel], exclude_keys: tuple[str, ...] = ("id",)
+) -> Type[BaseModel]:
+    """Arguments of a bulk tool: a list of rows of `sql_model`. Fields of a row
+    are optional in the schema, like those of the single row tools, so the model
+    doesn't make up values; missing values are reported per row"""
+    fields = {
+        name: (
+            Optional[field.annotation],
+            Field(default=None, description=field.description),
+        )
+        for name, field in sql_model.model_fields.items()
+        if name not in exclude_keys
+    }
+    row_model = create_model(f"{sql_model.__name__}Row", **fields)
+    return create_model(
+        f"{sql_model.__name__}Rows",
+        rows=(
+            list[row_model],
+            Field(description=f"The {sql_model.__name__.lower()} rows to add"),
+        ),
     )
 
 
@@ -1,10 +1,13 @@
 """Base class for tools"""
 
+import asyncio
 import inspect
-from typing import Any, Callable, Type, Union
 
-from langchain_core.utils.function_calling import convert_to_openai_tool
-from pydantic import BaseModel, ConfigDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Type, Union
+
+from pydantic import BaseModel, ConfigDict, PrivateAttr
 from sqlmodel import SQLModel
 
 from .convert import convert_to_openai_tool
@@ -13,10 +16,29 @@ from ...configs.logging_config import get_logger
 
 logger = get_logger(__name__)
 
+# Names of the tools that changed data in the current job, see `record_writes`
+_writes: ContextVar[list[str] | None] = ContextVar("tool_writes", default=None)
+
+
+@contextmanager
+def record_writes() -> Iterator[list[str]]:
+    """Collect the names of tools that succeeded and aren't read-only within
+    the block, including calls in tasks and threads started with its context.
+    A job that already wrote must not be run again, or it writes twice"""
+    writes = []
+    token = _writes.set(writes)
+    try:
+        yield writes
+    finally:
+        _writes.reset(token)
+
 
 class ToolResult(BaseModel):
     content: str
     success: bool
+    # What the tool stored, e.g. the added row as written, for replies
+    # rendered without the model
+    data: dict[str, Any] | None = None
 
 
 class Tool(BaseModel):
@@ -31,47 +53,115 @@ class Tool(BaseModel):
     validate_missing: bool = True
     parse_model: bool = False
     exclude_keys: list[str] = ["id"]
+    # Calls in the same step run concurrently unless they conflict: both touch
+    # a common resource and one of them writes. Tools of unknown resources
+    # conflict with every call that isn't read-only
+    read_only: bool = False
+    resources: tuple[str, ...] | None = None
+    resource_arg: str | None = None
 
-    model_config = ConfigDict(arbitrary_types_allowed=True)
+    model_config = ConfigDict(arbitrary_types_allowed=True, frozen=True)
+
+    # Compiled once, tools are shared by all requests
+    _schema: dict[str, Any] | None = PrivateAttr(default=None)
+    _required_keys: frozenset[str] = PrivateAttr(default=frozenset())
+    _parse: Callable | None = PrivateAttr(default=None)
+    _is_async: bool = PrivateAttr(default=False)
+    _resources: frozenset[str] | None = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        self._is_async = inspect.iscoroutinefunction(self.function)
+        if self.resources is not None:
+            self._resources = frozenset(self.resources)
+        elif getattr(self.model, "__table__", None) is not None:
+            # Rows may reference rows of other tables, e.g. a revenue its customer
+            table = self.model.__table__
+            self._resources = frozenset(
+                {table.name, *(key.column.table.name for key in table.foreign_keys)}
+            )
+        if self.model:
+            self._required_keys = frozenset(self.model.model_fields) - set(
+                self.exclude_keys
+            )
+            self._parse = getattr(self.model, "model_validate", None) or (
+                lambda kwargs: self.model(**kwargs)
+            )
 
     def run(self, **kwargs):
         """Responsible for executing the tool's function with the provided input arguments"""
+        if self._is_async:
+            return asyncio.run(self.arun(**kwargs))
 
         try:
-            logger.debug(
-                "Signature of self.function: %s", inspect.signature(self.function)
-            )
             missing_values = self.validate_input(**kwargs)
             if missing_values:
                 content = f"Missing values: {', '.join(missing_values)}"
                 return ToolResult(content=content, success=False)
             if self.parse_model:
-                if hasattr(self.model, "model_validate"):
-                    input_ = self.model.model_validate(kwargs)
-                else:
-                    input_ = self.model(**kwargs)
-                result = self.function(input_)
+                result = self.function(self._parse(kwargs))
             else:
                 result = self.function(**kwargs)
-            return ToolResult(content=str(result), success=True)
+            return self._result(result)
         except Exception as e:
             logger.error("Error running tool %s: %s", self.name, str(e))
             return ToolResult(
                 content="An error occurred while running the tool", success=False
             )
 
+    async def arun(self, **kwargs):
+        """Async counterpart of `run`. Coroutine functions are awaited, blocking
+        functions run in a worker thread so they don't stall the event loop"""
+        if not self._is_async:
+            return await asyncio.to_thread(self.run, **kwargs)
+
+        try:
+            missing_values = self.validate_input(**kwargs)
+            if missing_values:
+                content = f"Missing values: {', '.join(missing_values)}"
+                return ToolResult(content=content, success=False)
+            if self.parse_model:
+                result = await self.function(self._parse(kwargs))
+            else:
+                result = await self.function(**kwargs)
+            return self._result(result)
+        except Exception as e:
+            logger.error("Error running tool %s: %s", self.name, str(e))
+            return ToolResult(
+                content="An error occurred while running the tool", success=False
+            )
+
+    def _result(self, result) -> ToolResult:
+        if not isinstance(result, ToolResult):
+            result = ToolResult(content=str(result), success=True)
+        writes = _writes.get()
+        if result.success and not self.read_only and writes is not None:
+            writes.append(self.name)
+        return result
+
+    def resources_for(self, kwargs: dict) -> frozenset[str] | None:
+        """Resources a call with `kwargs` touches, `None` if unknown. Defaults to
+        the table of `model` and the tables it references, or the table named by
+        the `resource_arg` argument"""
+        if self.resource_arg and isinstance(kwargs.get(self.resource_arg), str):
+            return frozenset({kwargs[self.resource_arg].lower()})
+        return self._resources
+
     def validate_input(self, **kwargs) -> list[str]:
         """Compares the input arguments passed to the tool with the expected input
         schema defined in the `model`"""
         if not self.validate_missing or not self.model:
             return []
-        model_keys = set(self.model.__annotations__.keys()) - set(self.exclude_keys)
-        input_keys = set(kwargs.keys())
-        misssing_values = model_keys - input_keys
-        return list(misssing_values)
+        return list(self._required_keys.difference(kwargs))
 
     @property
     def openai_tool_schema(self) -> dict[str, Any]:
+        """The model in the OpenAI tool schema format, converted on first access.
+        The returned dict is shared and must not be modified."""
+        if self._schema is None:
+            self._schema = self.compile_schema()
+        return self._schema
+
+    def compile_schema(self) -> dict[str, Any]:
         """Convert the model to the OpenAI tool schema format. Additionally, it
         removes the `"required"` key from the schema, making all input parameters
         optional. This allows the agent to provide only the available information
@@ -33,6 +33,7 @@ def convert_pydantic_to_openai_function(
     )
     schema = dereference_refs(model_schema)
     schema.pop("definitions", None)
+    schema.pop("$defs", None)
     title = schema.pop("title", "")
     default_description = schema.pop("description", "")
     return {
@@ -1,22 +1,60 @@
 """Tool for querying data from the database"""
 
+import operator
+import re
+import threading
+
+from collections import OrderedDict
+from datetime import timezone
 from typing import Literal
 
-from pydantic import BaseModel
-from sqlmodel import select, Session, SQLModel
-from sqlalchemy import func, literal_column
+from pydantic import BaseModel, Field, ValidationError
+from sqlmodel import select, SQLModel
+from sqlalchemy import (
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    Numeric,
+    Select,
+    String,
+    bindparam,
+    cast,
+    func,
+)
+from sqlalchemy.exc import StatementError
+from sqlalchemy.types import NullType
 
 from .base import ToolResult
+from .results import QueryResult, encode_result
 
 from ...configs.logging_config import get_logger
+from ...configs.service_configs import QUERY_MAX_ROWS, QUERY_PLAN_CACHE_SIZE
+from ...infrastructure.metrics import REGISTRY
 
 from ...persistance import db
 from ...persistance.models import Customer, Expense, Revenue
+from ...persistance.query_cache import QueryResultCache
+from ...persistance.utils import validate_date
 
 logger = get_logger(__name__)
 
 TABLES = {"expense": Expense, "revenue": Revenue, "customer": Customer}
 
+AGGREGATES = {
+    "SUM": func.sum,
+    "AVG": func.avg,
+    "COUNT": func.count,
+    "MIN": func.min,
+    "MAX": func.max,
+}
+DATE_BUCKETS = ("YEAR", "QUARTER", "MONTH")
+# `FUNCTION(column)` or `COUNT(*)`
+EXPRESSION = re.compile(
+    rf"^\s*({'|'.join([*AGGREGATES, *DATE_BUCKETS])})\s*\(\s*(\*|\w+)\s*\)\s*$",
+    re.IGNORECASE,
+)
+
 
 class WhereStatement(BaseModel):
     column: str
@@ -24,15 +62,42 @@ class WhereStatement(BaseModel):
     value: str
 
 
+class OrderBy(BaseModel):
+    column: str
+    direction: Literal["asc", "desc"] = "asc"
+
+
 class QueryConfig(BaseModel):
     table_name: str
-    columns: list[str]
-    where: list[WhereStatement | None]
+    columns: list[str] = Field(
+        description="Columns or expressions to select, e.g. `description`, "
+        "`SUM(gross_amount)`, `COUNT(*)` or `MONTH(date)`. Aggregations are SUM, "
+        "AVG, COUNT, MIN and MAX; dates can be bucketed with YEAR, QUARTER and "
+        "MONTH"
+    )
+    where: list[WhereStatement | None] = Field(
+        default_factory=list, description="Conditions on rows, combined with AND"
+    )
+    group_by: list[str] = Field(
+        default_factory=list,
+        description="Columns or date buckets to aggregate by, e.g. "
+        "`customer_id` and `MONTH(date)`",
+    )
+    having: list[WhereStatement] = Field(
+        default_factory=list,
+        description="Conditions on aggregations, e.g. `SUM(gross_amount)` gt `1000`",
+    )
+    order_by: list[OrderBy] = Field(default_factory=list)
+    limit: int | None = Field(default=None, ge=1)
+    offset: int | None = Field(default=None, ge=0)
 
 
 def query_data_function(**kwargs) -> ToolResult:
     """Query the database through natural language"""
-    query_config = QueryConfig.model_validate(kwargs)
+    try:
+        query_config = QueryConfig.model_validate(kwargs)
+    except ValidationError as e:
+        return ToolResult(content=f"Invalid query: {e}", success=False)
 
     # Convert table name to lowercase for consistent lookup
     table_name_lower = query_config.table_name.lower()
@@ -43,76 +108,305 @@ def query_data_function(**kwargs) -> ToolResult:
         )
 
     sql_model = TABLES[table_name_lower]
-    data = sql_query_from_config(query_config, sql_model)
-
-    return ToolResult(content=f"Query results: {data}", success=True)
-
-
-def sql_query_from_config(query_config: QueryConfig, sql_model: SQLModel) -> list:
-    with Session(db.engine) as session:
-        selection = []
-        for column in query_config.columns:
-            # Handle SQL aggregation functions
-            if column.startswith("SUM(") and column.endswith(")"):
-                col_name = column[4:-1].strip()
-                if col_name not in sql_model.__annotations__:
-                    return f"Column {col_name} not found in model {sql_model.__name__}"
-                selection.append(func.sum(getattr(sql_model, col_name)))
-            elif column.startswith("AVG(") and column.endswith(")"):
-                col_name = column[4:-1].strip()
-                if col_name not in sql_model.__annotations__:
-                    return f"Column {col_name} not found in model {sql_model.__name__}"
-                selection.append(func.avg(getattr(sql_model, col_name)))
-            elif column.startswith("COUNT(") and column.endswith(")"):
-                col_name = column[6:-1].strip()
-                if col_name not in sql_model.__annotations__:
-                    return f"Column {col_name} not found in model {sql_model.__name__}"
-                selection.append(literal_column(f"COUNT({col_name})"))
-            else:
-                if column not in sql_model.__annotations__:
-                    return f"Column {column} not found in model {sql_model.__name__}"
-                selection.append(getattr(sql_model, column))
-
-        statement = select(*selection)
-        where_queries = query_config.where
-        if where_queries:
-            for where in where_queries:
-                if where.column not in sql_model.__annotations__:
-                    return f"Column {where['column']} not found in model {sql_model.__name__}"
-
-                elif where.operator == "eq":
-                    statement = statement.where(
-                        getattr(sql_model, where.column) == where.value
-                    )
-                elif where.operator == "gt":
-                    statement = statement.where(
-                        getattr(sql_model, where.column) > where.value
-                    )
-                elif where.operator == "lt":
-                    statement = statement.where(
-                        getattr(sql_model, where.column) < where.value
-                    )
-                elif where.operator == "gte":
-                    statement = statement.where(
-                        getattr(sql_model, where.column) >= where.value
-                    )
-                elif where.operator == "lte":
-                    statement = statement.where(
-                        getattr(sql_model, where.column) <= where.value
-                    )
-                elif where.operator == "ne":
-                    statement = statement.where(
-                        getattr(sql_model, where.column) != where.value
-                    )
-                elif where.operator == "ct":
-                    statement = statement.where(
-                        getattr(sql_model, where.column).contains(where.value)
-                    )
-
-        result = session.exec(statement=statement)
-        data = result.all()
-        try:
-            data = [repr(d) for d in data]
-        except:
-            pass
-    return data
+    data = result_cache.get_or_run(
+        sql_model.__tablename__,
+        query_config.model_copy(update={"table_name": table_name_lower}),
+        lambda: sql_query_from_config(query_config, sql_model),
+    )
+    if isinstance(data, str):
+        return ToolResult(content=data, success=False)
+
+    return ToolResult(content=f"Query results:\n{encode_result(data)}", success=True)
+
+
+def date_bucket(function: str, column):
+    """Label of the year, quarter or month of a date column, e.g. `2025-Q2`"""
+    if function == "YEAR":
+        return func.strftime("%Y", column)
+    if function == "MONTH":
+        return func.strftime("%Y-%m", column)
+    quarter = (cast(func.strftime("%m", column), Integer) + 2) // 3
+    return func.strftime("%Y", column) + "-Q" + cast(quarter, String)
+
+
+def is_date_column(column) -> bool:
+    # The affinity sees through type decorators, e.g. SQLModel's UTCDateTime
+    return issubclass(column.type._type_affinity, (Date, DateTime))
+
+
+def parse_expression(expression: str, sql_model: SQLModel):
+    """SQL expression of a column, an aggregation or a date bucket
+
+    Raises:
+        ValueError: Unknown column or function
+    """
+    match = EXPRESSION.match(expression)
+    function, col_name = (
+        (match.group(1).upper(), match.group(2))
+        if match
+        else (None, expression.strip())
+    )
+    if function == "COUNT" and col_name == "*":
+        return func.count().label("COUNT(*)")
+    if col_name not in sql_model.model_fields:
+        raise ValueError(f"Column {col_name} not found in model {sql_model.__name__}")
+    column = getattr(sql_model, col_name)
+    if function is None:
+        return column
+    label = f"{function}({col_name})"
+    if function in AGGREGATES:
+        return AGGREGATES[function](column).label(label)
+    if not is_date_column(column):
+        raise ValueError(f"{function} needs a date column, {col_name} is not one")
+    return date_bucket(function, column).label(label)
+
+
+def is_aggregate(expression: str) -> bool:
+    match = EXPRESSION.match(expression)
+    return bool(match) and match.group(1).upper() in AGGREGATES
+
+
+def contains(column, value):
+    # Substrings of numbers and dates too, e.g. "2025-03" of a date
+    return cast(column, String).contains(value)
+
+
+def parameter(name: str, operator_name: str):
+    """Bound parameter of a condition. Values of `ct` are text whatever the
+    column's type, which the parameter would take otherwise"""
+    if operator_name == "ct":
+        return bindparam(name, type_=String)
+    return bindparam(name)
+
+
+OPERATORS = {
+    "eq": operator.eq,
+    "gt": operator.gt,
+    "lt": operator.lt,
+    "gte": operator.ge,
+    "lte": operator.le,
+    "ne": operator.ne,
+    "ct": contains,
+}
+
+
+def coerce(value: str, sql_type, operator_name: str):
+    """`value` as the Python type of a column or expression of `sql_type`, so
+    it is compared as a number or date, not as text, and the column's index
+    can be used
+
+    Raises:
+        ValueError: `value` doesn't fit the type
+    """
+    if operator_name == "ct":
+        return value
+    affinity = getattr(sql_type, "_type_affinity", None) or NullType
+    try:
+        if issubclass(affinity, (Date, DateTime)):
+            date = validate_date(value)
+            # e.g. SQLModel's UTCDateTime only binds aware datetimes
+            if getattr(getattr(sql_type, "impl", sql_type), "timezone", False):
+                date = date.replace(tzinfo=timezone.utc)
+            return date
+        if issubclass(affinity, Integer):
+            number = float(value)
+            return int(number) if number.is_integer() else number
+        if issubclass(affinity, (Float, Numeric)):
+            return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            f"Value {value} can't be compared to {affinity.__name__}"
+        ) from None
+    return value
+
+
+class CompiledQuery:
+    """A statement with bound parameters for the values of a query shape"""
+
+    __slots__ = ("statement", "parameters")
+
+    def __init__(self, statement: Select, parameters: list[tuple]) -> None:
+        self.statement = statement
+        # (name, SQL type, operator) of the where and having values, in order
+        self.parameters = parameters
+
+    def bind(self, query_config: QueryConfig) -> dict:
+        """Parameters of the statement for the values of `query_config`
+
+        Raises:
+            ValueError: A value doesn't fit the type of its column
+        """
+        values = [where.value for where in query_config.where if where is not None]
+        values += [having.value for having in query_config.having]
+        params = {
+            name: coerce(value, sql_type, operator_name)
+            for (name, sql_type, operator_name), value in zip(self.parameters, values)
+        }
+        if query_config.limit is not None:
+            params["limit"] = query_config.limit
+        if query_config.offset is not None:
+            params["offset"] = query_config.offset
+        return params
+
+
+def query_shape(query_config: QueryConfig) -> tuple:
+    """Everything of `query_config` except its values, which are bound as
+    parameters"""
+    return (
+        query_config.table_name.lower(),
+        tuple(query_config.columns),
+        tuple(
+            (where.column, where.operator)
+            for where in query_config.where
+            if where is not None
+        ),
+        tuple(query_config.group_by),
+        tuple((having.column, having.operator) for having in query_config.having),
+        tuple((order.column, order.direction) for order in query_config.order_by),
+        query_config.limit is not None,
+        query_config.offset is not None,
+    )
+
+
+def compile_query(query_config: QueryConfig, sql_model: SQLModel) -> CompiledQuery:
+    """The select statement of the shape of `query_config`
+
+    Raises:
+        ValueError: Unknown column or function, or a misplaced aggregation
+    """
+    # Explicit, as COUNT(*) alone names no column to imply the table
+    statement = select(
+        *(parse_expression(column, sql_model) for column in query_config.columns)
+    ).select_from(sql_model)
+    parameters = []
+    for where in query_config.where:
+        if where is None:
+            continue
+        if is_aggregate(where.column):
+            raise ValueError(f"Use `having` for conditions on {where.column}")
+        expression = parse_expression(where.column, sql_model)
+        name = f"where_{len(parameters)}"
+        parameters.append((name, expression.type, where.operator))
+        statement = statement.where(
+            OPERATORS[where.operator](expression, parameter(name, where.operator))
+        )
+    if query_config.group_by:
+        statement = statement.group_by(
+            *(parse_expression(column, sql_model) for column in query_config.group_by)
+        )
+    for having in query_config.having:
+        expression = parse_expression(having.column, sql_model)
+        name = f"having_{len(parameters)}"
+        parameters.append((name, expression.type, having.operator))
+        statement = statement.having(
+            OPERATORS[having.operator](expression, parameter(name, having.operator))
+        )
+    for order in query_config.order_by:
+        expression = parse_expression(order.column, sql_model)
+        statement = statement.order_by(
+            expression.desc() if order.direction == "desc" else expression.asc()
+        )
+    if query_config.limit is not None:
+        statement = statement.limit(bindparam("limit", type_=Integer))
+    if query_config.offset is not None:
+        statement = statement.offset(bindparam("offset", type_=Integer))
+    return CompiledQuery(statement, parameters)
+
+
+class QueryCompiler:
+    """Compiled queries by shape. Questions like "expenses this month" differ
+    only in their values, so their statement is built once and reused, which
+    also lets SQLAlchemy reuse its compiled SQL"""
+
+    def __init__(self, max_size: int = QUERY_PLAN_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._queries: OrderedDict[tuple, CompiledQuery] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = REGISTRY.counter("query_plan_cache_hits")
+        self.misses = REGISTRY.counter("query_plan_cache_misses")
+
+    def compile(self, query_config: QueryConfig, sql_model: SQLModel) -> CompiledQuery:
+        """Raises:
+        ValueError: Unknown column or function, or a misplaced aggregation
+        """
+        shape = query_shape(query_config)
+        with self._lock:
+            query = self._queries.get(shape)
+            if query is not None:
+                self._queries.move_to_end(shape)
+                self.hits.inc()
+                return query
+        self.misses.inc()
+        query = compile_query(query_config, sql_model)
+        with self._lock:
+            self._queries[shape] = query
+            if len(self._queries) > self.max_size:
+                self._queries.popitem(last=False)
+        return query
+
+
+compiler = QueryCompiler()
+result_cache = QueryResultCache()
+
+
+def run_query(
+    statement: Select, params: dict | None = None, max_rows: int = QUERY_MAX_ROWS
+) -> QueryResult:
+    """Fetch at most `max_rows` rows of `statement`. If there are more, the
+    total and a summary of the numeric columns over all rows are computed in
+    SQL instead"""
+    with db.engine.connect() as connection:
+        result = connection.execute(statement, params or {})
+        columns = list(result.keys())
+        # Rows are read lazily, so only the first `max_rows` + 1 are fetched
+        rows = [tuple(row) for row in result.fetchmany(max_rows + 1)]
+        result.close()
+        if len(rows) <= max_rows:
+            return QueryResult(columns=columns, rows=rows, total=len(rows))
+
+        rows = rows[:max_rows]
+        subquery = statement.subquery()
+        subquery_columns = list(subquery.c)
+        # Sums of ids and foreign keys mean nothing
+        numeric = [
+            i
+            for i, column in enumerate(subquery_columns)
+            if not column.primary_key
+            and not column.foreign_keys
+            and isinstance(
+                next((row[i] for row in rows if row[i] is not None), None),
+                (int, float),
+            )
+        ]
+        # Counted from the subquery, which has no numeric column to imply it
+        summary_statement = select(
+            func.count(),
+            *(
+                function(subquery_columns[i])
+                for i in numeric
+                for function in (func.sum, func.min, func.max)
+            ),
+        ).select_from(subquery)
+        total, *aggregates = connection.execute(summary_statement, params or {}).one()
+    summary = {
+        columns[i]: dict(zip(("sum", "min", "max"), aggregates[j * 3 : j * 3 + 3]))
+        for j, i in enumerate(numeric)
+    }
+    return QueryResult(columns=columns, rows=rows, total=total, summary=summary)
+
+
+def sql_query_from_config(
+    query_config: QueryConfig, sql_model: SQLModel, max_rows: int = QUERY_MAX_ROWS
+) -> QueryResult | str:
+    """Run `query_config`, or return why it can't be run"""
+    try:
+        query = compiler.compile(query_config, sql_model)
+        params = query.bind(query_config)
+    except ValueError as e:
+        return str(e)
+    try:
+        return run_query(query.statement, params, max_rows)
+    except StatementError as e:
+        logger.warning("Query on %s failed: %s", sql_model.__name__, e)
+        return f"The query could not be run: {e.orig or e}"
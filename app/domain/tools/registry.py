@@ -0,0 +1,40 @@
+"""Lookup of tools and agents by name"""
+
+from typing import Any, Iterable, Iterator, Protocol
+
+
+class ToolLike(Protocol):
+    """Anything an agent can call, i.e. a `Tool` or a `TaskAgent`"""
+
+    name: str
+
+    @property
+    def openai_tool_schema(self) -> dict[str, Any]: ...
+
+
+class ToolRegistry:
+    """Tools indexed by name, with their OpenAI schemas collected once so a
+    request only has to look them up"""
+
+    def __init__(self, tools: Iterable[ToolLike] = ()) -> None:
+        self._tools = {tool.name: tool for tool in tools}
+        self.schemas = [tool.openai_tool_schema for tool in self._tools.values()]
+
+    def get(self, name: str) -> ToolLike:
+        try:
+            return self._tools[name]
+        except KeyError:
+            raise ValueError(f"Tool {name} not found in tools list.") from None
+
+    def with_tools(self, tools: Iterable[ToolLike]) -> "ToolRegistry":
+        """A new registry with `tools` added, replacing tools of the same name"""
+        return ToolRegistry([*self._tools.values(), *tools])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def __iter__(self) -> Iterator[ToolLike]:
+        return iter(self._tools.values())
+
+    def __len__(self) -> int:
+        return len(self._tools)
@@ -0,0 +1,124 @@
+"""Compact text encoding of query results
+
+Results are sent to the model as CSV with a single header line instead of a
+`repr` per row, which repeats nothing and keeps numbers short. Results with more
+rows than the cap are cut, and state the total number of rows and the sum,
+minimum and maximum of each numeric column over all of them, so the model can
+still answer questions about the whole result.
+"""
+
+import csv
+import io
+import timeit
+
+from datetime import date, datetime, time
+
+from pydantic import BaseModel
+
+from ...configs.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Enough for cents and tax rates, without float noise like 83.60000000000001
+DECIMALS = 4
+
+
+class QueryResult(BaseModel):
+    columns: list[str]
+    rows: list[tuple]
+    # Rows of the whole result, more than `rows` if they were cut
+    total: int
+    # Column -> sum, min and max over all rows, only if rows were cut
+    summary: dict[str, dict[str, float | None]] = {}
+
+
+def encode_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return repr(round(value, DECIMALS))
+    if isinstance(value, datetime):
+        if value.time() == time():
+            return value.strftime("%Y-%m-%d")
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_result(result: QueryResult) -> str:
+    """`result` as CSV, preceded by the number of rows and followed by the
+    summary of the rows that were cut"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if len(result.rows) < result.total:
+        buffer.write(f"First {len(result.rows)} of {result.total} rows\n")
+    else:
+        buffer.write(f"{result.total} rows\n")
+    writer.writerow(result.columns)
+    writer.writerows([encode_value(value) for value in row] for row in result.rows)
+    if result.summary:
+        buffer.write(f"Over all {result.total} rows:\n")
+        for column, aggregates in result.summary.items():
+            buffer.write(
+                f"{column}: "
+                + ", ".join(
+                    f"{name} {encode_value(value)}"
+                    for name, value in aggregates.items()
+                )
+                + "\n"
+            )
+    return buffer.getvalue().rstrip("\n")
+
+
+def main() -> None:
+    """Compare size and cost of the encoding with a `repr` per row"""
+    from ..agents.prompt import count_tokens
+
+    rows = [
+        (
+            i,
+            f"Office supplies {i}",
+            round(i * 1.37, 2),
+            round(i * 1.37 * 1.1, 2),
+            0.1,
+            datetime(2025, 1 + i % 12, 1 + i % 28),
+        )
+        for i in range(2000)
+    ]
+    columns = ["id", "description", "net_amount", "gross_amount", "tax_rate", "date"]
+    for cap in (50, 2000):
+        result = QueryResult(
+            columns=columns,
+            rows=rows[:cap],
+            total=len(rows),
+            summary=(
+                {
+                    columns[i]: {
+                        "sum": sum(row[i] for row in rows),
+                        "min": min(row[i] for row in rows),
+                        "max": max(row[i] for row in rows),
+                    }
+                    for i in (2, 3)
+                }
+                if cap < len(rows)
+                else {}
+            ),
+        )
+        text = encode_result(result)
+        seconds = timeit.timeit(lambda: encode_result(result), number=20) / 20
+        logger.info(
+            "CSV, %s rows: %s tokens, %.2f ms", cap, count_tokens(text), seconds * 1e3
+        )
+    text = f"Query results: {[repr(row) for row in rows]}"
+    seconds = timeit.timeit(lambda: [repr(row) for row in rows], number=20) / 20
+    logger.info(
+        "repr, %s rows: %s tokens, %.2f ms",
+        len(rows),
+        count_tokens(text),
+        seconds * 1e3,
+    )
+
+
+if __name__ == "__main__":
+    main()
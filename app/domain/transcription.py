@@ -0,0 +1,168 @@
+"""Chunked transcription of long voice notes
+
+Long audio is split at silences into chunks of roughly `TRANSCRIPTION_CHUNK_SECONDS`
+that are transcribed in parallel and stitched back together in order. Splitting
+needs `pydub` (and ffmpeg to decode Opus voice notes); without it every note
+is transcribed in a single call. The duration is read from the Ogg container
+first, so short notes, the common case, are never decoded.
+"""
+
+import io
+import os
+import struct
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    TRANSCRIPTION_CHUNK_SECONDS,
+    TRANSCRIPTION_CHUNK_WORKERS,
+)
+from ..infrastructure.metrics import REGISTRY
+
+try:
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+    from pydub.utils import mediainfo_json
+except ImportError:
+    AudioSegment = None
+
+logger = get_logger(__name__)
+
+# Silence shorter than this is a pause between words, not between sentences
+MIN_SILENCE_MS = 400
+# Silence is anything this many dB quieter than the average loudness
+SILENCE_THRESHOLD_DB = 16
+# Whisper resamples to 16 kHz mono anyway, so chunks are exported that way
+CHUNK_FRAME_RATE = 16000
+# Opus granule positions count samples at 48 kHz, whatever the input rate
+OPUS_GRANULE_RATE = 48000
+# The last Ogg page is at most 64 KiB, so it is within this tail of the file
+OGG_TAIL_BYTES = 65536 + 27 + 255
+
+# Shared by all workers so concurrent long notes can't exceed the bound
+_pool = ThreadPoolExecutor(
+    max_workers=TRANSCRIPTION_CHUNK_WORKERS, thread_name_prefix="transcription"
+)
+
+chunk_count = REGISTRY.histogram("transcription_chunks", buckets=(1, 2, 4, 8, 16))
+decodes_skipped = REGISTRY.counter("transcription_decodes_skipped")
+transcription_seconds = REGISTRY.histogram("transcription_seconds")
+
+
+def cut_points(
+    duration_ms: int, silences: list[tuple[int, int]], chunk_ms: int
+) -> list[int]:
+    """Choose where to cut audio of `duration_ms` into chunks of about `chunk_ms`.
+    Each cut is placed in the middle of the silence closest to the target
+    length, and falls back to a hard cut if there is no silence nearby"""
+    midpoints = [(start + end) // 2 for start, end in silences]
+    cuts = []
+    start = 0
+    while duration_ms - start > chunk_ms * 1.5:
+        target = start + chunk_ms
+        window = (start + chunk_ms // 2, start + chunk_ms * 3 // 2)
+        nearby = [m for m in midpoints if window[0] <= m <= window[1]]
+        cut = min(nearby, key=lambda m: abs(m - target)) if nearby else target
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+
+def ogg_opus_duration(audio_file: BinaryIO) -> float | None:
+    """Duration of an Ogg Opus file, e.g. a WhatsApp voice note, from the
+    granule position of its last page. `None` for other formats"""
+    audio_file.seek(0)
+    head = audio_file.read(64)
+    if not head.startswith(b"OggS") or b"OpusHead" not in head:
+        return None
+    opus_head = head.index(b"OpusHead")
+    # OpusHead: magic, version, channel count, then the pre-skip in samples
+    (pre_skip,) = struct.unpack_from("<H", head, opus_head + 10)
+    size = audio_file.seek(0, os.SEEK_END)
+    audio_file.seek(max(size - OGG_TAIL_BYTES, 0))
+    tail = audio_file.read()
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or last_page + 14 > len(tail):
+        return None
+    (granule,) = struct.unpack_from("<q", tail, last_page + 6)
+    if granule < 0:
+        return None
+    return max(granule - pre_skip, 0) / OPUS_GRANULE_RATE
+
+
+def audio_duration(audio_file: BinaryIO) -> float | None:
+    """Duration of `audio_file` in seconds without decoding it, `None` if it
+    can't be determined"""
+    try:
+        duration = ogg_opus_duration(audio_file)
+        if duration is None and AudioSegment is not None:
+            # ffprobe only reads the container, much cheaper than decoding
+            audio_file.seek(0)
+            duration = float(mediainfo_json(audio_file)["format"]["duration"])
+    except Exception as e:
+        logger.debug("Could not read audio duration: %s", e)
+        duration = None
+    audio_file.seek(0)
+    return duration
+
+
+def split_at_silence(
+    audio_file: BinaryIO, chunk_seconds: float = TRANSCRIPTION_CHUNK_SECONDS
+) -> list[io.BytesIO] | None:
+    """Split audio into WAV chunks at silences. Returns `None` if the audio is
+    short enough for a single call or can't be decoded"""
+    if AudioSegment is None:
+        return None
+    chunk_ms = int(chunk_seconds * 1000)
+    duration = audio_duration(audio_file)
+    if duration is not None and duration * 1000 <= chunk_ms * 1.5:
+        decodes_skipped.inc()
+        return None
+    try:
+        audio = AudioSegment.from_file(audio_file)
+    except Exception as e:
+        logger.warning("Could not decode audio for chunking: %s", e)
+        return None
+    if len(audio) <= chunk_ms * 1.5:
+        return None
+    silences = detect_silence(
+        audio,
+        min_silence_len=MIN_SILENCE_MS,
+        silence_thresh=audio.dBFS - SILENCE_THRESHOLD_DB,
+    )
+    bounds = [0, *cut_points(len(audio), silences, chunk_ms), len(audio)]
+    audio = audio.set_channels(1).set_frame_rate(CHUNK_FRAME_RATE)
+    chunks = []
+    for start, end in zip(bounds, bounds[1:]):
+        chunk = io.BytesIO()
+        audio[start:end].export(chunk, format="wav")
+        chunk.seek(0)
+        chunks.append(chunk)
+    return chunks
+
+
+def transcribe_chunked(
+    audio_file: BinaryIO,
+    filename: str,
+    transcribe: Callable[[BinaryIO, str], str],
+) -> str:
+    """Transcribe `audio_file` with `transcribe`, in parallel chunks if it is
+    long"""
+    start = time.monotonic()
+    chunks = split_at_silence(audio_file)
+    if not chunks:
+        audio_file.seek(0)
+        text = transcribe(audio_file, filename)
+        chunk_count.observe(1)
+    else:
+        names = [f"{filename.rsplit('.', 1)[0]}-{i}.wav" for i in range(len(chunks))]
+        # `map` returns the results in the order of the chunks
+        texts = list(_pool.map(transcribe, chunks, names))
+        text = " ".join(part.strip() for part in texts if part.strip())
+        chunk_count.observe(len(chunks))
+        logger.info("Transcribed %s in %s chunks", filename, len(chunks))
+    transcription_seconds.observe(time.monotonic() - start)
+    return text
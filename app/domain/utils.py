@@ -1,22 +1,35 @@
 """Utility functions and classes"""
 
+import timeit
 import types
 import typing
 
-from datetime import datetime
+from datetime import date, datetime
+from functools import lru_cache
 
 import sqlalchemy
 
 from pydantic import BaseModel
+from sqlmodel import SQLModel
 
 from ..configs.logging_config import get_logger
 from ..configs.model_configs import CONTEXT_STRING, DAYS
-from ..persistance.models import Expense, Revenue
+from ..persistance.models import Customer, Expense, Revenue
 
 logger = get_logger(__name__)
 
 
-def orm_model_to_string(input_model_cls: BaseModel) -> str:
+def model_annotations(model: BaseModel) -> dict:
+    """Annotations of `model` and the models it extends, e.g. the fields of
+    `ExpenseBase` and the relationships of `Expense`"""
+    annotations = {}
+    for cls in reversed(model.__mro__):
+        if issubclass(cls, BaseModel) and cls not in (BaseModel, SQLModel):
+            annotations.update(vars(cls).get("__annotations__", {}))
+    return annotations
+
+
+def render_model(input_model_cls: BaseModel) -> str:
     """Convert ORM model to string format for LLM usage"""
 
     def process_field(key, value):
@@ -34,19 +47,56 @@ def orm_model_to_string(input_model_cls: BaseModel) -> str:
     fields = dict(
         filter(
             None,
-            (process_field(k, v) for k, v in input_model_cls.__annotations__.items()),
+            (
+                process_field(k, v)
+                for k, v in model_annotations(input_model_cls).items()
+            ),
         )
     )
     return ", ".join([f"{k} = <{v.__name__}>" for k, v in fields.items()])
 
 
-def generate_context(*table_models) -> str:
+def model_fingerprint(model: BaseModel) -> tuple:
+    """Changes when a field or table column of `model` is added, removed,
+    renamed or retyped, which invalidates its cached description"""
+    fields = tuple(
+        (name, repr(annotation))
+        for name, annotation in model_annotations(model).items()
+    )
+    table = getattr(model, "__table__", None)
+    columns = (
+        tuple((column.name, repr(column.type)) for column in table.columns)
+        if table is not None
+        else ()
+    )
+    return fields, columns
+
+
+@lru_cache(maxsize=256)
+def _render_model(model: BaseModel, fingerprint: tuple) -> str:
+    return render_model(model)
+
+
+def orm_model_to_string(input_model_cls: BaseModel) -> str:
+    """Convert ORM model to string format for LLM usage, rendered once per
+    model"""
+    return _render_model(input_model_cls, model_fingerprint(input_model_cls))
+
+
+@lru_cache(maxsize=256)
+def _render_context(table_models: tuple, fingerprints: tuple) -> str:
     context_str = CONTEXT_STRING
     for table in table_models:
         context_str += f"- {table.__name__}: {orm_model_to_string(table)}\n"
     return context_str
 
 
+def generate_context(*table_models) -> str:
+    return _render_context(
+        table_models, tuple(model_fingerprint(table) for table in table_models)
+    )
+
+
 def weekday_by_date(date: datetime, days: list[str] | None = None) -> str:
     """Extrapolate day of the week from date"""
     if days is None:
@@ -64,21 +114,51 @@ def date_to_string(date: datetime) -> str:
     return f"{weekday_by_date(date)} {parse_date(date)}"
 
 
+_today: tuple[date, str] | None = None
+
+
+def today_context() -> str:
+    """Today's date for the volatile part of a prompt, rendered again only when
+    the day rolls over"""
+    global _today
+    today = date.today()
+    cached = _today
+    if cached is None or cached[0] != today:
+        cached = _today = (today, f"Today is {date_to_string(today)}")
+    return cached[1]
+
+
 def generate_query_context(*table_models) -> str:
     """Provide complete query context, including talbe and date information"""
-    today = f"Today is {date_to_string(datetime.now())}"
-    context_str = CONTEXT_STRING
-    for table in table_models:
-        context_str += f"- {table.__name__}: {orm_model_to_string(table)}\n"
-    return f"{today}\n{context_str}"
+    return f"{today_context()}\n{generate_context(*table_models)}"
 
 
 def main() -> None:
-    """Run script"""
+    """Run script, and compare the cost of the query context per message
+    without and with the cache"""
     logger.info(generate_query_context(Expense, Revenue))
     logger.info(generate_query_context(Expense))
     logger.info(generate_query_context(Revenue))
 
+    models = (Expense, Revenue, Customer)
+
+    def uncached() -> str:
+        context_str = CONTEXT_STRING
+        for table in models:
+            context_str += f"- {table.__name__}: {render_model(table)}\n"
+        return f"Today is {date_to_string(datetime.now())}\n{context_str}"
+
+    number = 10000
+    before = timeit.timeit(uncached, number=number) / number
+    after = timeit.timeit(lambda: generate_query_context(*models), number=number)
+    after /= number
+    logger.info(
+        "Query context per message: %.1f µs uncached, %.1f µs cached (%.0fx)",
+        before * 1e6,
+        after * 1e6,
+        before / after,
+    )
+
 
 if __name__ == "__main__":
     main()
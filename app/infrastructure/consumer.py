@@ -0,0 +1,147 @@
+"""Feeds jobs from the durable inbox to the dispatcher"""
+
+import asyncio
+import inspect
+import os
+import socket
+import threading
+import time
+from typing import Awaitable, Callable
+
+from .dispatcher import Dispatcher
+
+from ..configs.logging_config import get_logger
+from ..domain.tools.base import record_writes
+from ..configs.service_configs import DISPATCHER_SHUTDOWN_TIMEOUT, INBOX_POLL_INTERVAL
+from ..persistance.inbox import Inbox
+from ..persistance.models import InboxJob
+
+logger = get_logger(__name__)
+
+
+class InboxConsumer:
+    """Claims inbox jobs whenever the dispatcher has idle workers. Each process
+    runs one consumer, so adding uvicorn workers adds processing capacity
+    without any coordination beyond the inbox leases.
+
+    Jobs are submitted to one dispatcher lane per phone number, so the messages
+    of a user are answered in order and a quick burst of them is handled as a
+    single batch.
+    """
+
+    def __init__(
+        self,
+        inbox: Inbox,
+        dispatcher: Dispatcher,
+        handler: Callable[[list[InboxJob]], None | Awaitable[None]],
+        poll_interval: float = INBOX_POLL_INTERVAL,
+        owner: str | None = None,
+    ) -> None:
+        self.inbox = inbox
+        self.dispatcher = dispatcher
+        self.handler = handler
+        self.is_async = inspect.iscoroutinefunction(handler)
+        self.poll_interval = poll_interval
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._unstarted: dict[int, InboxJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"inbox-consumer-{self.owner}", daemon=True
+        )
+        self._thread.start()
+
+    def wake(self) -> None:
+        """Claim new jobs immediately instead of waiting for the next poll"""
+        self._wake.set()
+
+    def drain(self, timeout: float = DISPATCHER_SHUTDOWN_TIMEOUT) -> None:
+        """Stop claiming, wait for the dispatcher to finish the jobs it holds and
+        hand any job that never started back to the inbox"""
+        deadline = time.monotonic() + timeout
+        self._stopping.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=max(deadline - time.monotonic(), 0))
+            self._thread = None
+        self.dispatcher.stop(timeout=max(deadline - time.monotonic(), 0))
+        with self._lock:
+            unstarted = list(self._unstarted.values())
+            self._unstarted.clear()
+        if unstarted:
+            logger.info("Releasing %s unstarted inbox jobs", len(unstarted))
+            self.inbox.release(unstarted)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            claimed = 0
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logger.error("Error claiming inbox jobs: %s", e, exc_info=True)
+            if not claimed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _claim(self) -> int:
+        capacity = self.dispatcher.idle_capacity
+        if not capacity:
+            return 0
+        jobs = self.inbox.claim(self.owner, limit=capacity)
+        process = self._aprocess if self.is_async else self._process
+        for job in jobs:
+            with self._lock:
+                self._unstarted[job.id] = job
+            self.dispatcher.submit_to_lane(job.phone, job, process)
+        return len(jobs)
+
+    def _start(self, jobs: list[InboxJob]) -> list[InboxJob]:
+        with self._lock:
+            # Jobs missing here were released to the inbox by a drain that timed out
+            return [job for job in jobs if self._unstarted.pop(job.id, None)]
+
+    def _fail(self, jobs: list[InboxJob], error: str, writes: list[str]) -> None:
+        if writes:
+            # Running the jobs again would repeat the writes, e.g. add a row twice
+            logger.error(
+                "Not retrying inbox jobs %s, %s already changed data",
+                [job.id for job in jobs],
+                ", ".join(writes),
+            )
+        for job in jobs:
+            self.inbox.fail(job, error, retry=not writes)
+
+    def _complete(self, jobs: list[InboxJob]) -> None:
+        for job in jobs:
+            self.inbox.complete(job)
+
+    def _process(self, jobs: list[InboxJob]) -> None:
+        jobs = self._start(jobs)
+        if not jobs:
+            return
+        with record_writes() as writes:
+            try:
+                self.handler(jobs)
+            except Exception as e:
+                self._fail(jobs, str(e), writes)
+                raise
+        self._complete(jobs)
+
+    async def _aprocess(self, jobs: list[InboxJob]) -> None:
+        jobs = self._start(jobs)
+        if not jobs:
+            return
+        with record_writes() as writes:
+            try:
+                await self.handler(jobs)
+            except Exception as e:
+                await asyncio.to_thread(self._fail, jobs, str(e), writes)
+                raise
+        await asyncio.to_thread(self._complete, jobs)
@@ -0,0 +1,346 @@
+"""Bounded job queue and worker pool for processing incoming messages"""
+
+import asyncio
+import heapq
+import inspect
+import queue
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+from .event_loop import EventLoopThread
+from .metrics import REGISTRY
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    DISPATCHER_DEBOUNCE_SECONDS,
+    DISPATCHER_MAX_CONCURRENCY,
+    DISPATCHER_MAX_DEBOUNCE_SECONDS,
+    DISPATCHER_MAX_QUEUE_SIZE,
+    DISPATCHER_SHUTDOWN_TIMEOUT,
+    DISPATCHER_WORKERS,
+)
+from ..domain.exceptions import QueueFullError
+
+logger = get_logger(__name__)
+
+_STOP = object()
+
+
+class Job:
+    """A function call waiting in the dispatcher queue"""
+
+    __slots__ = ("func", "args", "kwargs", "size", "enqueued_at")
+
+    def __init__(
+        self, func: Callable, args: tuple, kwargs: dict[str, Any], size: int = 1
+    ) -> None:
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.size = size
+        self.enqueued_at = time.monotonic()
+
+
+class Lane:
+    """Items submitted under the same key, e.g. the messages of one user. A lane
+    runs at most one batch at a time, so items of the same key are processed in
+    order while different lanes run in parallel."""
+
+    __slots__ = (
+        "key",
+        "handler",
+        "is_async",
+        "items",
+        "first_at",
+        "last_at",
+        "running",
+    )
+
+    def __init__(self, key: Hashable, handler: Callable[[list], None]) -> None:
+        self.key = key
+        self.handler = handler
+        self.is_async = inspect.iscoroutinefunction(handler)
+        self.items: list = []
+        self.first_at = 0.0
+        self.last_at = 0.0
+        self.running = False
+
+
+class Dispatcher:
+    """Runs submitted jobs on a fixed number of worker threads. The number of
+    waiting jobs is bounded, so a burst of messages is rejected with a
+    `QueueFullError` instead of spawning an unbounded number of threads.
+
+    Items submitted to a lane are held back until the lane has been quiet for
+    `debounce_seconds` (but no longer than `max_debounce_seconds`) and then
+    handed to the lane's handler as one batch. Coroutine handlers run on
+    `loop` instead of a worker thread, so up to `max_concurrency` lanes can wait
+    on I/O at the same time with only a few threads.
+    """
+
+    def __init__(
+        self,
+        workers: int = DISPATCHER_WORKERS,
+        max_queue_size: int = DISPATCHER_MAX_QUEUE_SIZE,
+        debounce_seconds: float = DISPATCHER_DEBOUNCE_SECONDS,
+        max_debounce_seconds: float = DISPATCHER_MAX_DEBOUNCE_SECONDS,
+        name: str = "dispatcher",
+        loop: EventLoopThread | None = None,
+        max_concurrency: int = DISPATCHER_MAX_CONCURRENCY,
+    ) -> None:
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.debounce_seconds = debounce_seconds
+        self.max_debounce_seconds = max(max_debounce_seconds, debounce_seconds)
+        self.name = name
+        self.loop = loop
+        self.max_concurrency = max_concurrency
+        self._queue: queue.Queue = queue.Queue()
+        self._threads: list[threading.Thread] = []
+        self._scheduler: threading.Thread | None = None
+        self._accepting = False
+        self._pending = 0
+        self._lanes: dict[Hashable, Lane] = {}
+        self._timers: list[tuple[float, int, Hashable]] = []
+        self._timer_seq = 0
+        self._async_running = 0
+        self._cond = threading.Condition()
+
+        self.submitted = REGISTRY.counter(f"{name}_jobs_submitted")
+        self.rejected = REGISTRY.counter(f"{name}_jobs_rejected")
+        self.completed = REGISTRY.counter(f"{name}_jobs_completed")
+        self.failed = REGISTRY.counter(f"{name}_jobs_failed")
+        self.coalesced = REGISTRY.counter(f"{name}_items_coalesced")
+        self.in_flight = REGISTRY.gauge(f"{name}_jobs_in_flight")
+        self.queue_depth = REGISTRY.gauge(
+            f"{name}_queue_depth", callback=lambda: self._pending
+        )
+        REGISTRY.gauge(f"{name}_lanes", callback=lambda: len(self._lanes))
+        REGISTRY.gauge(f"{name}_async_in_flight", callback=lambda: self._async_running)
+        self.wait_seconds = REGISTRY.histogram(f"{name}_queue_wait_seconds")
+        self.run_seconds = REGISTRY.histogram(f"{name}_job_run_seconds")
+        self.batch_size = REGISTRY.histogram(
+            f"{name}_lane_batch_size", buckets=(1, 2, 3, 5, 10, 20)
+        )
+
+    @property
+    def is_running(self) -> bool:
+        return self._accepting
+
+    @property
+    def idle_capacity(self) -> int:
+        """Number of jobs that could start right away on an idle worker, or on
+        the event loop if there is one"""
+        busy = self._queue.qsize() + self.in_flight.value + self._async_running
+        free = self.max_queue_size - self._pending
+        limit = self.max_concurrency if self.loop else self.workers
+        return max(min(limit - busy, free), 0)
+
+    def start(self) -> None:
+        """Start the worker threads"""
+        if self._accepting:
+            return
+        self._accepting = True
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"{self.name}-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        self._scheduler = threading.Thread(
+            target=self._schedule, name=f"{self.name}-scheduler", daemon=True
+        )
+        self._scheduler.start()
+        logger.info("Started %s with %s workers", self.name, self.workers)
+
+    def _reserve(self) -> None:
+        if not self._accepting:
+            raise RuntimeError(f"{self.name} is not running")
+        if self._pending >= self.max_queue_size:
+            self.rejected.inc()
+            raise QueueFullError(self.max_queue_size)
+        self._pending += 1
+        self.submitted.inc()
+
+    def submit(self, func: Callable, *args, **kwargs) -> None:
+        """Queue `func(*args, **kwargs)` for execution on a worker thread
+
+        Raises:
+            QueueFullError: `max_queue_size` jobs are already waiting
+        """
+        with self._cond:
+            self._reserve()
+            self._queue.put(Job(func, args, kwargs))
+
+    def submit_to_lane(
+        self, key: Hashable, item: Any, handler: Callable[[list], None]
+    ) -> None:
+        """Add `item` to the lane `key`. Once the lane is quiet, `handler` is
+        called on a worker thread with all the items collected so far
+
+        Raises:
+            QueueFullError: `max_queue_size` jobs are already waiting
+        """
+        with self._cond:
+            self._reserve()
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = Lane(key, handler)
+            now = time.monotonic()
+            if not lane.items:
+                lane.first_at = now
+            lane.last_at = now
+            lane.items.append(item)
+            self._add_timer(lane)
+
+    def _ready_at(self, lane: Lane) -> float:
+        return min(
+            lane.last_at + self.debounce_seconds,
+            lane.first_at + self.max_debounce_seconds,
+        )
+
+    def _add_timer(self, lane: Lane) -> None:
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (self._ready_at(lane), self._timer_seq, lane.key))
+        self._cond.notify_all()
+
+    def _schedule(self) -> None:
+        """Move lanes whose debounce window has passed onto the work queue"""
+        with self._cond:
+            while self._accepting or self._timers:
+                if not self._timers:
+                    self._cond.wait()
+                    continue
+                ready_at, _, key = self._timers[0]
+                now = time.monotonic()
+                if self._accepting and ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+                heapq.heappop(self._timers)
+                lane = self._lanes.get(key)
+                if lane is None or lane.running or not lane.items:
+                    continue
+                if self._accepting and self._ready_at(lane) > now:
+                    # A newer item pushed the lane back, its own timer fires later
+                    continue
+                items, lane.items = lane.items, []
+                lane.running = True
+                self.batch_size.observe(len(items))
+                self.coalesced.inc(len(items) - 1)
+                if lane.is_async and self.loop:
+                    self._start_async_lane(lane, items)
+                else:
+                    self._queue.put(Job(self._run_lane, (lane, items), {}, len(items)))
+
+    def _run_lane(self, lane: Lane, items: list) -> None:
+        try:
+            if lane.is_async:
+                asyncio.run(lane.handler(items))
+            else:
+                lane.handler(items)
+        finally:
+            with self._cond:
+                self._release_lane(lane)
+
+    def _release_lane(self, lane: Lane) -> None:
+        lane.running = False
+        if lane.items:
+            self._add_timer(lane)
+        elif self._lanes.get(lane.key) is lane:
+            del self._lanes[lane.key]
+
+    def _start_async_lane(self, lane: Lane, items: list) -> None:
+        """Run a coroutine lane on the event loop, called with `_cond` held"""
+        self._pending -= len(items)
+        start = time.monotonic()
+        try:
+            future = self.loop.submit(lane.handler(items))
+        except RuntimeError as e:
+            self.failed.inc()
+            logger.error("Lane %s failed in %s: %s", lane.key, self.name, e)
+            self._release_lane(lane)
+            return
+        self._async_running += 1
+        future.add_done_callback(
+            lambda future: self._finish_async_lane(lane, start, future)
+        )
+
+    def _finish_async_lane(self, lane: Lane, start: float, future) -> None:
+        self.run_seconds.observe(time.monotonic() - start)
+        error = future.exception() if not future.cancelled() else "cancelled"
+        if error:
+            self.failed.inc()
+            logger.error(
+                "Lane %s failed in %s: %s",
+                lane.key,
+                self.name,
+                error,
+                exc_info=error if isinstance(error, BaseException) else None,
+            )
+        else:
+            self.completed.inc()
+        with self._cond:
+            self._async_running -= 1
+            self._release_lane(lane)
+            self._cond.notify_all()
+
+    def stop(self, timeout: float = DISPATCHER_SHUTDOWN_TIMEOUT) -> None:
+        """Stop accepting jobs, let the workers finish what is already queued and
+        wait for them for at most `timeout` seconds. Lanes waiting for their
+        debounce window are flushed right away; items that arrive in a lane while
+        it is running are left unprocessed."""
+        with self._cond:
+            if not self._accepting:
+                return
+            self._accepting = False
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        if self._scheduler:
+            self._scheduler.join(timeout=max(deadline - time.monotonic(), 0))
+            self._scheduler = None
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        alive = [thread.name for thread in self._threads if thread.is_alive()]
+        if alive:
+            logger.warning("%s stopped with busy workers: %s", self.name, alive)
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: not self._async_running,
+                timeout=max(deadline - time.monotonic(), 0),
+            ):
+                logger.warning(
+                    "%s stopped with %s lanes running on the event loop",
+                    self.name,
+                    self._async_running,
+                )
+        self._threads = []
+        logger.info("Stopped %s", self.name)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            with self._cond:
+                self._pending -= job.size
+            self.wait_seconds.observe(time.monotonic() - job.enqueued_at)
+            self.in_flight.inc()
+            start = time.monotonic()
+            try:
+                job.func(*job.args, **job.kwargs)
+                self.completed.inc()
+            except Exception as e:
+                self.failed.inc()
+                logger.error(
+                    "Job %s failed in %s: %s",
+                    getattr(job.func, "__name__", job.func),
+                    self.name,
+                    e,
+                    exc_info=True,
+                )
+            finally:
+                self.run_seconds.observe(time.monotonic() - start)
+                self.in_flight.dec()
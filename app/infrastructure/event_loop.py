@@ -0,0 +1,76 @@
+"""Asyncio event loop running on a dedicated thread"""
+
+import asyncio
+import threading
+
+from concurrent.futures import Future
+from typing import Coroutine
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import DISPATCHER_SHUTDOWN_TIMEOUT
+
+logger = get_logger(__name__)
+
+
+class EventLoopThread:
+    """Runs coroutines submitted from other threads, e.g. agent runs started by
+    the dispatcher. While a coroutine waits for OpenAI it holds no thread, so a
+    single loop serves many conversations at once."""
+
+    def __init__(self, name: str = "event-loop") -> None:
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._loop is not None and self._loop.is_running()
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(started,), name=self.name, daemon=True
+        )
+        self._thread.start()
+        started.wait()
+        logger.info("Started %s", self.name)
+
+    def _run(self, started: threading.Event) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(started.set)
+        try:
+            self._loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            self._loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True)
+            )
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.run_until_complete(self._loop.shutdown_default_executor())
+            self._loop.close()
+
+    def submit(self, coroutine: Coroutine) -> Future:
+        """Schedule `coroutine` on the loop and return a future for its result
+
+        Raises:
+            RuntimeError: The loop is not running
+        """
+        if not self.is_running:
+            coroutine.close()
+            raise RuntimeError(f"{self.name} is not running")
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def stop(self, timeout: float = DISPATCHER_SHUTDOWN_TIMEOUT) -> None:
+        """Stop the loop, cancelling coroutines that are still running"""
+        if not self._thread:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+        self._loop = None
+        logger.info("Stopped %s", self.name)
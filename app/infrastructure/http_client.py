@@ -0,0 +1,171 @@
+"""Pooled HTTP client for the Meta Graph API
+
+The client keeps connections alive between calls, so replies don't pay a new
+TCP and TLS handshake each time. Requests answered with 429 or 5xx, or failing
+at the transport level, are retried with jittered exponential backoff. POSTs
+are not idempotent, so they are only retried after transport errors raised
+before the request was sent, e.g. not after a read timeout.
+"""
+
+import random
+import time
+
+from typing import BinaryIO
+
+import httpx
+
+from .metrics import REGISTRY
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_RETRIES,
+    HTTP_RETRY_BACKOFF,
+    HTTP_TIMEOUT,
+    MEDIA_CHUNK_SIZE,
+)
+
+logger = get_logger(__name__)
+
+GRAPH_API_URL = "https://graph.facebook.com"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Raised before any byte of the request reached the server
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+request_seconds = REGISTRY.histogram("graph_api_request_seconds")
+request_retries = REGISTRY.counter("graph_api_request_retries")
+request_errors = REGISTRY.counter("graph_api_request_errors")
+
+
+def _client_options(api_key: str | None, timeout: float, max_connections: int):
+    return {
+        "base_url": GRAPH_API_URL,
+        "headers": {"Authorization": f"Bearer {api_key}"},
+        "timeout": httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    }
+
+
+def _should_retry(response: httpx.Response | None, attempt: int, retries: int):
+    if attempt >= retries:
+        return False
+    return response is None or response.status_code in RETRY_STATUS_CODES
+
+
+def _retryable_error(method: str, error: httpx.TransportError) -> bool:
+    return method.upper() in IDEMPOTENT_METHODS or isinstance(error, CONNECT_ERRORS)
+
+
+def _backoff_delay(response: httpx.Response | None, attempt: int, backoff: float):
+    """Honor `Retry-After` if the API sent one, otherwise use full jitter"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+    return random.uniform(0, backoff * 2**attempt)
+
+
+class GraphAPIClient:
+    def __init__(
+        self,
+        api_key: str | None,
+        timeout: float = HTTP_TIMEOUT,
+        max_retries: int = HTTP_MAX_RETRIES,
+        backoff: float = HTTP_RETRY_BACKOFF,
+        max_connections: int = HTTP_MAX_CONNECTIONS,
+    ) -> None:
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client = httpx.Client(
+            **_client_options(api_key, timeout, max_connections)
+        )
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, retrying on 429/5xx and transport errors, which for
+        non-idempotent methods are limited to connect errors. The response of
+        the last attempt is returned whatever its status code.
+
+        Raises:
+            httpx.TransportError: The last attempt failed at the transport level
+        """
+        attempt = 0
+        while True:
+            response = None
+            start = time.monotonic()
+            try:
+                response = self._client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                request_errors.inc()
+                if not _retryable_error(method, e) or not _should_retry(
+                    None, attempt, self.max_retries
+                ):
+                    raise
+                logger.warning("Graph API %s %s failed: %s", method, url, e)
+            finally:
+                request_seconds.observe(time.monotonic() - start)
+            if not _should_retry(response, attempt, self.max_retries):
+                return response
+            request_retries.inc()
+            time.sleep(_backoff_delay(response, attempt, self.backoff))
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    def download(
+        self, url: str, file: BinaryIO, max_bytes: int | None = None, **kwargs
+    ) -> httpx.Response:
+        """Stream the body of a GET request into `file` chunk by chunk, so the
+        body is never held in memory as a whole. Retries like `request`; the
+        body of an unsuccessful response is read and left on the response.
+
+        Raises:
+            ValueError: The body is larger than `max_bytes`
+            httpx.TransportError: The last attempt failed at the transport level
+        """
+        attempt = 0
+        while True:
+            response = None
+            start = time.monotonic()
+            try:
+                with self._client.stream("GET", url, **kwargs) as response:
+                    if response.is_success:
+                        written = 0
+                        for chunk in response.iter_bytes(MEDIA_CHUNK_SIZE):
+                            written += len(chunk)
+                            if max_bytes and written > max_bytes:
+                                raise ValueError(
+                                    f"Download exceeds the limit of {max_bytes} bytes"
+                                )
+                            file.write(chunk)
+                    else:
+                        response.read()
+            except httpx.TransportError as e:
+                request_errors.inc()
+                response = None
+                if not _should_retry(None, attempt, self.max_retries):
+                    raise
+                logger.warning("Graph API download %s failed: %s", url, e)
+            finally:
+                request_seconds.observe(time.monotonic() - start)
+            if response is not None and (
+                response.is_success
+                or not _should_retry(response, attempt, self.max_retries)
+            ):
+                return response
+            file.seek(0)
+            file.truncate()
+            request_retries.inc()
+            time.sleep(_backoff_delay(response, attempt, self.backoff))
+            attempt += 1
+
+    def close(self) -> None:
+        self._client.close()
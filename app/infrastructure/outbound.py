@@ -0,0 +1,254 @@
+"""Rate-limited scheduler for outbound WhatsApp messages
+
+Messages are sent by a few sender threads. Each WhatsApp phone number id has
+its own token bucket, so sustained throughput stays at the Graph API tier
+instead of running into 429s. Interactive replies are sent before bulk
+messages, failed sends are retried with backoff and messages that still fail
+end up in the dead-letter store.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from enum import IntEnum
+
+import httpx
+
+from .http_client import CONNECT_ERRORS, RETRY_STATUS_CODES, GraphAPIClient
+from .metrics import REGISTRY
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    DISPATCHER_SHUTDOWN_TIMEOUT,
+    OUTBOUND_BURST,
+    OUTBOUND_MAX_ATTEMPTS,
+    OUTBOUND_RATE_PER_SECOND,
+    OUTBOUND_RETRY_BACKOFF,
+    OUTBOUND_SENDERS,
+)
+from ..persistance.outbox import DeadLetterStore
+
+logger = get_logger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it"""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for the next `seconds`, e.g. after a 429"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class OutboundMessage:
+    __slots__ = (
+        "phone_number_id",
+        "url",
+        "payload",
+        "priority",
+        "attempts",
+        "enqueued_at",
+    )
+
+    def __init__(
+        self, phone_number_id: str, url: str, payload: dict, priority: Priority
+    ) -> None:
+        self.phone_number_id = phone_number_id
+        self.url = url
+        self.payload = payload
+        self.priority = priority
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundScheduler:
+    def __init__(
+        self,
+        client: GraphAPIClient,
+        dead_letters: DeadLetterStore | None = None,
+        rate: float = OUTBOUND_RATE_PER_SECOND,
+        burst: int = OUTBOUND_BURST,
+        senders: int = OUTBOUND_SENDERS,
+        max_attempts: int = OUTBOUND_MAX_ATTEMPTS,
+        retry_backoff: float = OUTBOUND_RETRY_BACKOFF,
+    ) -> None:
+        self.client = client
+        self.dead_letters = dead_letters or DeadLetterStore()
+        self.rate = rate
+        self.burst = burst
+        self.senders = senders
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._buckets: dict[str, TokenBucket] = {}
+        self._ready: list[tuple[int, int, OutboundMessage]] = []
+        self._delayed: list[tuple[float, int, OutboundMessage]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._running = False
+
+        self.sent = REGISTRY.counter("outbound_messages_sent")
+        self.retried = REGISTRY.counter("outbound_messages_retried")
+        self.dead_lettered = REGISTRY.counter("outbound_messages_dead_lettered")
+        REGISTRY.gauge(
+            "outbound_queue_depth",
+            callback=lambda: len(self._ready) + len(self._delayed),
+        )
+        self.throttle_seconds = REGISTRY.histogram("outbound_throttle_seconds")
+        self.delivery_seconds = REGISTRY.histogram("outbound_delivery_seconds")
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        for i in range(self.senders):
+            thread = threading.Thread(
+                target=self._send_loop, name=f"outbound-sender-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = DISPATCHER_SHUTDOWN_TIMEOUT) -> None:
+        """Send what is ready, then move pending retries to the dead-letter store"""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        self._threads = []
+        with self._cond:
+            remaining = [message for *_, message in self._ready + self._delayed]
+            self._ready, self._delayed = [], []
+        for message in remaining:
+            self._dead_letter(message, "Scheduler stopped before delivery")
+
+    def enqueue(
+        self,
+        phone_number_id: str,
+        url: str,
+        payload: dict,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> None:
+        message = OutboundMessage(phone_number_id, url, payload, priority)
+        with self._cond:
+            heapq.heappush(self._ready, (priority, next(self._seq), message))
+            self._cond.notify()
+
+    def _bucket(self, phone_number_id: str) -> TokenBucket:
+        with self._cond:
+            if phone_number_id not in self._buckets:
+                self._buckets[phone_number_id] = TokenBucket(self.rate, self.burst)
+            return self._buckets[phone_number_id]
+
+    def _next(self) -> OutboundMessage | None:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, message = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (message.priority, seq, message))
+                if self._ready:
+                    return heapq.heappop(self._ready)[2]
+                if not self._running:
+                    return None
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _send_loop(self) -> None:
+        while True:
+            message = self._next()
+            if message is None:
+                return
+            bucket = self._bucket(message.phone_number_id)
+            delay = bucket.reserve()
+            if delay:
+                self.throttle_seconds.observe(delay)
+                time.sleep(delay)
+            self._send(message, bucket)
+
+    def _send(self, message: OutboundMessage, bucket: TokenBucket) -> None:
+        message.attempts += 1
+        retryable = True
+        try:
+            response = self.client.post(message.url, json=message.payload)
+            if response.is_success:
+                self.sent.inc()
+                self.delivery_seconds.observe(time.monotonic() - message.enqueued_at)
+                logger.info("Sent message to WhatsApp API: %s", response.text)
+                return
+            error = f"Status code {response.status_code}: {response.text}"
+            retryable = response.status_code in RETRY_STATUS_CODES
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After", "")
+                bucket.pause(
+                    float(retry_after) if retry_after.isdigit() else self.retry_backoff
+                )
+        except httpx.HTTPError as e:
+            error = str(e)
+            # The message may have been delivered unless the connection failed
+            retryable = isinstance(e, CONNECT_ERRORS)
+        except Exception as e:
+            # Anything else, e.g. a payload that cannot be encoded, fails the same
+            # way on every attempt and must not end the sender thread
+            logger.exception("Unexpected error sending message to WhatsApp API")
+            self._dead_letter(message, repr(e))
+            return
+
+        if not retryable or message.attempts >= self.max_attempts:
+            self._dead_letter(message, error)
+            return
+        logger.warning("Error sending message to WhatsApp API, retrying: %s", error)
+        self.retried.inc()
+        delay = random.uniform(0, self.retry_backoff * 2**message.attempts)
+        with self._cond:
+            heapq.heappush(
+                self._delayed, (time.monotonic() + delay, next(self._seq), message)
+            )
+            self._cond.notify()
+
+    def _dead_letter(self, message: OutboundMessage, error: str) -> None:
+        logger.error("Error sending message to WhatsApp API: %s", error)
+        self.dead_lettered.inc()
+        self.dead_letters.add(
+            phone_number_id=message.phone_number_id,
+            url=message.url,
+            payload=message.payload,
+            priority=message.priority,
+            attempts=message.attempts,
+            error=error,
+        )
@@ -1,18 +1,31 @@
 """Main script"""
 
 import os
-import threading
+import re
 import sys
 
-from typing_extensions import Annotated
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Iterator
 
 import uvicorn
 
 from dotenv import load_dotenv
-from fastapi import Depends, HTTPException, FastAPI, Query, Request
+from fastapi import HTTPException, FastAPI, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
 
 from .domain import message_service
+from .domain.exceptions import QueueFullError
 from .configs.logging_config import get_logger
+from .configs.service_configs import RETRY_AFTER_SECONDS
+from .infrastructure.consumer import InboxConsumer
+from .infrastructure.dispatcher import Dispatcher
+from .infrastructure.event_loop import EventLoopThread
+from .infrastructure.metrics import REGISTRY
+from .persistance.db import create_db_and_tables
+from .persistance.dedup import DedupStore
+from .persistance.inbox import Inbox
 from .schema import Audio, Image, Message, Payload, User
 
 logger = get_logger(__name__)
@@ -20,6 +33,36 @@ load_dotenv()
 
 VERIFICATION_TOKEN = os.getenv("VERIFICATION_TOKEN")
 IS_DEV_ENVIRONMENT = os.getenv("ENV").lower() != "production"
+# `"field": "messages"` is present in every callback, only the key matters
+MESSAGES_KEY = re.compile(rb'"messages"\s*:')
+
+# Agent runs wait for OpenAI on their own loop, away from the webhook
+agent_loop = EventLoopThread("agent-loop")
+dispatcher = Dispatcher(loop=agent_loop)
+inbox = Inbox()
+dedup = DedupStore()
+consumer = InboxConsumer(inbox, dispatcher, message_service.aprocess_inbox_jobs)
+
+webhook_messages = REGISTRY.counter("webhook_messages_received")
+webhook_skipped = REGISTRY.counter("webhook_status_callbacks_skipped")
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    create_db_and_tables()
+    message_service.users.start()
+    message_service.outbound.start()
+    agent_loop.start()
+    dispatcher.start()
+    consumer.start()
+    yield
+    # Finish in-flight work and return unstarted jobs to the inbox
+    consumer.drain()
+    agent_loop.stop()
+    message_service.outbound.stop()
+    message_service.graph_api.close()
+    message_service.users.stop()
+
 
 app = FastAPI(
     title="WhatsApp AI ERP",
@@ -30,6 +73,7 @@ app = FastAPI(
     swagger_ui_oauth2_redirect_url=(
         "/docs/oauth2-redirect" if IS_DEV_ENVIRONMENT else None
     ),
+    lifespan=lifespan,
 )
 
 
@@ -60,95 +104,128 @@ def readiness() -> dict[str, str]:
     return {"status": "ready"}
 
 
-def parse_message(payload: Payload) -> Message | None:
-    if not payload.entry[0].changes[0].value.messages:
-        return None
-    return payload.entry[0].changes[0].value.messages[0]
+@app.get("/metrics")
+def metrics() -> dict:
+    return REGISTRY.snapshot()
 
 
-def get_current_user(
-    message: Annotated[Message, Depends(parse_message)] | None,
-) -> User | None:
-    if not message:
-        return None
+def iter_messages(payload: Payload) -> Iterator[Message]:
+    """Every message of every change of every entry. Meta batches several
+    messages into a single delivery under load."""
+    for entry in payload.entry:
+        for change in entry.changes:
+            yield from change.value.messages or []
+
+
+def get_current_user(message: Message) -> User | None:
     return message_service.authenticate_user_by_phone_number(message.from_)
 
 
-def parse_audio_file(
-    message: Annotated[Message, Depends(parse_message)],
-) -> Audio | None:
-    if message and message.type == "audio":
+def parse_audio_file(message: Message) -> Audio | None:
+    if message.type == "audio":
         return message.audio
     return None
 
 
-def parse_image_file(
-    message: Annotated[Message, Depends(parse_message)],
-) -> Image | None:
-    if message and message.type == "image":
+def parse_image_file(message: Message) -> Image | None:
+    if message.type == "image":
         return message.image
     return None
 
 
-def message_extractor(
-    message: Annotated[Message, Depends(parse_message)] | None,
-    audio: Annotated[Audio, Depends(parse_audio_file)] | None,
-):
-    if audio:
-        return message_service.transcribe_audio(audio)
-    if message and message.text:
-        return message.text.body
-    return None
-
+def has_user_message(message: Message) -> bool:
+    # Voice notes are transcribed by the workers, off the request path
+    return bool(parse_audio_file(message) or message.text)
 
-@app.post("/", status_code=200)
-async def receive_whatsapp(
-    request: Request,
-    payload: Payload,
-) -> dict[str, str]:
-    logger.info("Message received")
 
-    try:
-        # Log the raw incoming request body
-        body = await request.json()
-        logger.info(f"Received webhook payload: {body}")
-
-        # Use existing parsing logic to extract data from the payload
-        message = parse_message(payload)
-        user = get_current_user(message)
-        audio = parse_audio_file(message)
-        image = parse_image_file(message)
-        user_message = message_extractor(message, audio)
-
-    except Exception as e:
-        logger.error(f"Error processing webhook payload: {e}")
-        # Re-raise the exception or return an appropriate error response if needed
-        raise HTTPException(status_code=400, detail=f"Error processing payload: {e}")
+def accept_message(message: Message) -> str | None:
+    """Store `message` in the inbox if it can be answered, and return what
+    happened to it
 
-    if not user and not user_message and not image:
-        return {"status": "ok"}
+    Raises:
+        HTTPException: The inbox is full
+    """
+    user = get_current_user(message)
     if not user:
         logger.warning("Unauthorized: User not found for incoming message.")
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    if image:
+        return "unauthorized"
+    if parse_image_file(message):
         logger.info("Image received (processing not implemented)")
-        return {"status": "image received"}
-    if user_message:
-        logger.info(
-            "Message received from %s %s (%s)",
-            user.first_name,
-            user.last_name,
-            user.phone,
+        return "image"
+    if not has_user_message(message):
+        logger.info("Received unhandled message type or content.")
+        return None
+    logger.info(
+        "Message received from %s %s (%s)",
+        user.first_name,
+        user.last_name,
+        user.phone,
+    )
+    try:
+        job = inbox.enqueue(
+            message.id, user.phone, message.model_dump_json(by_alias=True)
         )
-        thread = threading.Thread(
-            target=message_service.respond_and_send_message, args=(user_message, user)
+    except QueueFullError as e:
+        # Meta retries the whole delivery, messages already in the inbox are
+        # ignored on retry
+        logger.warning("Inbox full (%s jobs), rejecting message", e.max_size)
+        raise HTTPException(
+            status_code=503,
+            detail="Service busy",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
         )
-        thread.daemon = True
-        thread.start()
-        return {"status": "message processed"}
+    return "accepted" if job else "duplicate"
+
+
+def accept_messages(payload: Payload) -> Counter:
+    """Accept every new message of `payload` and count what happened to them"""
+    counts = Counter()
+    for message in iter_messages(payload):
+        webhook_messages.inc()
+        if dedup.seen(message.id):
+            logger.info("Skipping duplicate delivery of message %s", message.id)
+            counts["duplicate"] += 1
+            continue
+        try:
+            status = accept_message(message)
+        except Exception:
+            # The id is remembered, so Meta's retry would be skipped and the
+            # message lost. The inbox's unique message id still keeps jobs
+            # that were stored from being enqueued twice
+            dedup.forget(message.id)
+            raise
+        counts[status] += 1
+        if status == "accepted":
+            consumer.wake()
+    return counts
 
-    # Fallback for unhandled message types if any reach this point
-    logger.info("Received unhandled message type or content.")
+
+@app.post("/", status_code=200)
+async def receive_whatsapp(request: Request) -> dict[str, str]:
+    body = await request.body()
+    # Delivery and read receipts only carry `statuses`, skip them unparsed
+    if not MESSAGES_KEY.search(body):
+        webhook_skipped.inc()
+        return {"status": "ok"}
+
+    try:
+        payload = Payload.model_validate_json(body)
+    except ValidationError as e:
+        logger.error("Error processing webhook payload: %s", e)
+        raise HTTPException(status_code=400, detail=f"Error processing payload: {e}")
+    logger.debug("Received webhook payload: %s", body)
+
+    # Dedup lookups and inbox writes are SQLite commits, keep them off the loop
+    counts = await run_in_threadpool(accept_messages, payload)
+
+    if counts["accepted"]:
+        return {"status": "message processed"}
+    if counts["unauthorized"]:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if counts["image"]:
+        return {"status": "image received"}
+    if counts["duplicate"]:
+        return {"status": "duplicate"}
     return {"status": "unhandled"}
 
 
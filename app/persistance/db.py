@@ -5,6 +5,7 @@ import os
 from pathlib import Path
 
 from dotenv import load_dotenv
+from sqlalchemy import event, inspect, text
 from sqlmodel import SQLModel, create_engine, Session
 
 from ..configs.logging_config import get_logger
@@ -29,10 +30,55 @@ else:
 engine = create_engine(DB_URL_TO_USE, echo=True)
 
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, _) -> None:
+    """Use write-ahead logging so several worker processes can read while one
+    of them writes"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def add_missing_columns() -> None:
+    """Add columns that were added to a model after its table was created,
+    e.g. `Employee.role`. `create_all` only creates missing tables. Only
+    nullable columns can be added to a table that has rows"""
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.error(
+                    "Cannot add required column %s.%s, migrate it manually",
+                    table.name,
+                    column.name,
+                )
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table.name}" '
+                        f'ADD COLUMN "{column.name}" {column_type}'
+                    )
+                )
+            logger.info("Added column %s.%s", table.name, column.name)
+
+
 def create_db_and_tables() -> None:
     """Create database tables if they don't exist"""
     try:
         SQLModel.metadata.create_all(engine)
+        add_missing_columns()
+        # `create_all` skips existing tables, including indexes added later
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
         logger.info("Database tables created successfully")
     except Exception as e:
         logger.error("Error creating database tables: %s", str(e))
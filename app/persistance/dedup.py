@@ -0,0 +1,112 @@
+"""De-duplication of webhook retries by WhatsApp message id"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, delete
+
+from . import db
+from .models import ProcessedMessage
+from .utils import utc_now
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    DEDUP_MAX_SIZE,
+    DEDUP_PERSISTENT,
+    DEDUP_TTL_SECONDS,
+)
+from ..infrastructure.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+PRUNE_EVERY = 1000
+
+
+class DedupStore:
+    """Remembers message ids for `ttl_seconds`. Lookups hit an in-memory store of
+    the `max_size` most recent ids first. With `persistent`, ids are also
+    recorded in the `processedmessage` table so retries delivered to another
+    worker process are recognized as well."""
+
+    def __init__(
+        self,
+        ttl_seconds: int = DEDUP_TTL_SECONDS,
+        max_size: int = DEDUP_MAX_SIZE,
+        persistent: bool = DEDUP_PERSISTENT,
+        engine: Engine | None = None,
+    ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.persistent = persistent
+        self.engine = engine or db.engine
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = 0
+
+        self.hits = REGISTRY.counter("dedup_hits")
+        self.misses = REGISTRY.counter("dedup_misses")
+        REGISTRY.gauge("dedup_memory_size", callback=lambda: len(self._seen))
+
+    def seen(self, message_id: str) -> bool:
+        """Check whether `message_id` was seen before and remember it otherwise"""
+        if self._seen_in_memory(message_id) or (
+            self.persistent and self._seen_in_db(message_id)
+        ):
+            self.hits.inc()
+            return True
+        self.misses.inc()
+        return False
+
+    def forget(self, message_id: str) -> None:
+        """Drop `message_id`, e.g. when it was rejected and will be retried"""
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.persistent:
+            with Session(self.engine) as session:
+                session.exec(
+                    delete(ProcessedMessage).where(
+                        ProcessedMessage.message_id == message_id
+                    )
+                )
+                session.commit()
+
+    def _seen_in_memory(self, message_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            # Entries share the same TTL, so the oldest ones expire first
+            while self._seen and next(iter(self._seen.values())) <= now:
+                self._seen.popitem(last=False)
+            if message_id in self._seen:
+                return True
+            self._seen[message_id] = now + self.ttl_seconds
+            if len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+        return False
+
+    def _seen_in_db(self, message_id: str) -> bool:
+        now = utc_now()
+        expired = now - timedelta(seconds=self.ttl_seconds)
+        # Inserts a new id or refreshes an expired one; a live id is left untouched
+        statement = (
+            insert(ProcessedMessage)
+            .values(message_id=message_id, seen_at=now)
+            .on_conflict_do_update(
+                index_elements=["message_id"],
+                set_={"seen_at": now},
+                where=ProcessedMessage.seen_at < expired,
+            )
+        )
+        with Session(self.engine) as session:
+            result = session.exec(statement)
+            self._inserts += 1
+            if self._inserts % PRUNE_EVERY == 0:
+                session.exec(
+                    delete(ProcessedMessage).where(ProcessedMessage.seen_at < expired)
+                )
+            session.commit()
+        return not result.rowcount
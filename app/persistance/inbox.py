@@ -0,0 +1,225 @@
+"""Durable inbox of accepted webhook messages
+
+Jobs are claimed with a lease: a claim atomically marks up to `limit` jobs as
+leased by one owner until `lease_expires_at`. Several worker processes can
+therefore pull from the same table, and jobs leased by a process that crashed
+become claimable again once their lease expires. While an owner holds a lease
+on a job of a phone number, other owners skip that number's jobs, so the
+messages of a user stay in one process and are answered in order.
+"""
+
+import uuid
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, delete, select, update
+
+from . import db
+from .models import InboxJob, InboxStatus
+from .utils import utc_now
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    INBOX_LEASE_SECONDS,
+    INBOX_MAX_ATTEMPTS,
+    INBOX_MAX_PENDING,
+    INBOX_RETENTION_SECONDS,
+    INBOX_RETRY_BACKOFF,
+)
+from ..domain.exceptions import QueueFullError
+from ..infrastructure.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+PRUNE_EVERY = 1000
+
+
+class Inbox:
+    def __init__(
+        self,
+        engine: Engine | None = None,
+        lease_seconds: int = INBOX_LEASE_SECONDS,
+        max_attempts: int = INBOX_MAX_ATTEMPTS,
+        max_pending: int = INBOX_MAX_PENDING,
+        retry_backoff: float = INBOX_RETRY_BACKOFF,
+        retention_seconds: int = INBOX_RETENTION_SECONDS,
+    ) -> None:
+        self.engine = engine or db.engine
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.retry_backoff = retry_backoff
+        self.retention_seconds = retention_seconds
+        self._finished = 0
+
+        self.enqueued = REGISTRY.counter("inbox_jobs_enqueued")
+        self.claimed = REGISTRY.counter("inbox_jobs_claimed")
+        self.completed = REGISTRY.counter("inbox_jobs_completed")
+        self.retried = REGISTRY.counter("inbox_jobs_retried")
+        self.failed = REGISTRY.counter("inbox_jobs_failed")
+        self.released = REGISTRY.counter("inbox_jobs_released")
+        REGISTRY.gauge("inbox_jobs_pending", callback=self.pending_count)
+
+    @staticmethod
+    def _claimable(now: datetime):
+        return or_(
+            and_(InboxJob.status == InboxStatus.PENDING, InboxJob.available_at <= now),
+            and_(
+                InboxJob.status == InboxStatus.LEASED,
+                InboxJob.lease_expires_at < now,
+            ),
+        )
+
+    def pending_count(self) -> int:
+        """Number of jobs that are not yet processed"""
+        with Session(self.engine) as session:
+            return session.exec(
+                select(func.count(InboxJob.id)).where(
+                    InboxJob.status.in_([InboxStatus.PENDING, InboxStatus.LEASED])
+                )
+            ).one()
+
+    def enqueue(self, message_id: str, phone: str, payload: str) -> InboxJob | None:
+        """Persist a job. Returns `None` if a job for `message_id` already exists
+
+        Raises:
+            QueueFullError: `max_pending` jobs are already waiting
+        """
+        if self.max_pending and self.pending_count() >= self.max_pending:
+            raise QueueFullError(self.max_pending)
+        job = InboxJob(message_id=message_id, phone=phone, payload=payload)
+        try:
+            with Session(self.engine) as session:
+                session.add(job)
+                session.commit()
+                session.refresh(job)
+        except IntegrityError:
+            logger.info("Message %s already in inbox", message_id)
+            return None
+        self.enqueued.inc()
+        return job
+
+    def claim(self, owner: str, limit: int = 1) -> list[InboxJob]:
+        """Lease up to `limit` claimable jobs for `owner`, oldest first"""
+        if limit < 1:
+            return []
+        now = utc_now()
+        token = uuid.uuid4().hex
+        busy_phones = select(InboxJob.phone).where(
+            InboxJob.status == InboxStatus.LEASED,
+            InboxJob.lease_expires_at >= now,
+            InboxJob.lease_owner != owner,
+        )
+        candidates = (
+            select(InboxJob.id)
+            .where(self._claimable(now), InboxJob.phone.not_in(busy_phones))
+            .order_by(InboxJob.id)
+            .limit(limit)
+        )
+        with Session(self.engine) as session:
+            # A single UPDATE is atomic, so concurrent claims never lease the same
+            # job twice
+            session.exec(
+                update(InboxJob)
+                .where(InboxJob.id.in_(candidates))
+                .values(
+                    status=InboxStatus.LEASED,
+                    lease_owner=owner,
+                    lease_token=token,
+                    lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+                    attempts=InboxJob.attempts + 1,
+                    updated_at=now,
+                )
+            )
+            session.commit()
+            jobs = session.exec(
+                select(InboxJob)
+                .where(InboxJob.lease_token == token)
+                .order_by(InboxJob.id)
+            ).all()
+        self.claimed.inc(len(jobs))
+        return list(jobs)
+
+    def _update_leased(self, job: InboxJob, **values) -> bool:
+        with Session(self.engine) as session:
+            result = session.exec(
+                update(InboxJob)
+                .where(
+                    InboxJob.id == job.id,
+                    InboxJob.lease_token == job.lease_token,
+                    InboxJob.status == InboxStatus.LEASED,
+                )
+                .values(updated_at=utc_now(), **values)
+            )
+            session.commit()
+        if not result.rowcount:
+            logger.warning("Lost lease on inbox job %s", job.id)
+        return bool(result.rowcount)
+
+    def complete(self, job: InboxJob) -> None:
+        if self._update_leased(
+            job, status=InboxStatus.DONE, lease_owner=None, lease_expires_at=None
+        ):
+            self.completed.inc()
+            self._finish()
+
+    def fail(self, job: InboxJob, error: str, retry: bool = True) -> None:
+        """Schedule a retry with exponential backoff, or give up after
+        `max_attempts` or if the job must not be retried"""
+        if not retry or job.attempts >= self.max_attempts:
+            logger.error("Inbox job %s failed permanently: %s", job.id, error)
+            if self._update_leased(
+                job, status=InboxStatus.FAILED, last_error=error, lease_owner=None
+            ):
+                self.failed.inc()
+                self._finish()
+            return
+        delay = self.retry_backoff * 2 ** (job.attempts - 1)
+        if self._update_leased(
+            job,
+            status=InboxStatus.PENDING,
+            last_error=error,
+            lease_owner=None,
+            lease_expires_at=None,
+            available_at=utc_now() + timedelta(seconds=delay),
+        ):
+            self.retried.inc()
+
+    def _finish(self) -> None:
+        self._finished += 1
+        if self._finished % PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self) -> int:
+        """Delete done and failed jobs last updated more than `retention_seconds`
+        ago. Returns the number of deleted jobs"""
+        expired = utc_now() - timedelta(seconds=self.retention_seconds)
+        try:
+            with Session(self.engine) as session:
+                result = session.exec(
+                    delete(InboxJob).where(
+                        InboxJob.status.in_([InboxStatus.DONE, InboxStatus.FAILED]),
+                        InboxJob.updated_at < expired,
+                    )
+                )
+                session.commit()
+        except Exception as e:
+            # Finished jobs are only kept for inspection, so pruning may wait
+            logger.error("Error pruning inbox: %s", e)
+            return 0
+        return result.rowcount
+
+    def release(self, jobs: list[InboxJob]) -> None:
+        """Hand leased jobs that were never started back to the inbox"""
+        for job in jobs:
+            if self._update_leased(
+                job,
+                status=InboxStatus.PENDING,
+                attempts=InboxJob.attempts - 1,
+                lease_owner=None,
+                lease_expires_at=None,
+            ):
+                self.released.inc()
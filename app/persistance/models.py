@@ -1,13 +1,14 @@
 """Database models"""
 
 from datetime import time, datetime
+from enum import Enum
 from typing import Optional
 
 from pydantic import BeforeValidator, model_validator
 from sqlmodel import SQLModel, Field, UniqueConstraint, Relationship
 from typing_extensions import Annotated
 
-from .utils import numeric_validator, validate_date, validate_time
+from .utils import numeric_validator, utc_now, validate_date, validate_time
 
 from ..configs.logging_config import get_logger
 from ..configs.model_configs import TAX_RATE
@@ -29,6 +30,8 @@ class Employee(SQLModel, table=True):
     city: str
     zip: str
     country: str
+    # Employees with a role may use the WhatsApp assistant
+    role: Optional[str] = None
 
 
 class Event(SQLModel, table=True):
@@ -77,15 +80,19 @@ class TimeTracking(SQLModel, table=True):
     end_time: TimeFormat
 
 
-class Revenue(SQLModel, table=True):
+class RevenueBase(SQLModel):
+    """Fields and validation of a revenue, without the table. Validators that
+    set attributes only work on models without a table"""
+
     id: Optional[int] = Field(primary_key=True, default=None)
     description: str
-    net_amount: Numeric
-    gross_amount: Numeric
+    net_amount: Numeric = Field(index=True)
+    gross_amount: Numeric = Field(index=True)
     tax_rate: Numeric
-    date: DateFormat
-    customer_id: Optional[int] = Field(default=None, foreign_key="customer.id")
-    customer: Optional["Customer"] = Relationship(back_populates="revenues")
+    date: DateFormat = Field(index=True)
+    customer_id: Optional[int] = Field(
+        default=None, foreign_key="customer.id", index=True
+    )
 
     @model_validator(mode="before")
     @classmethod
@@ -108,24 +115,34 @@ class Revenue(SQLModel, table=True):
         return data
 
 
-class Expense(SQLModel, table=True):
+class Revenue(RevenueBase, table=True):
+    customer: Optional["Customer"] = Relationship(back_populates="revenues")
+
+
+class ExpenseBase(SQLModel):
+    """Fields and validation of an expense, without the table"""
+
     id: Optional[int] = Field(default=None, primary_key=True)
     description: str = Field(index=True)
-    net_amount: Numeric = Field(description="The net amount of the expense")
+    net_amount: Numeric = Field(index=True, description="The net amount of the expense")
     gross_amount: Optional[Numeric] = Field(
-        default=None, description="The gross amount including tax"
+        default=None, index=True, description="The gross amount including tax"
     )
     tax_rate: Numeric = Field(default=TAX_RATE, description="The tax rate applied")
     date: DateFormat = Field(index=True)
 
     @model_validator(mode="after")
-    def calculate_gross_amount(self) -> "Expense":
+    def calculate_gross_amount(self) -> "ExpenseBase":
         """Calculate gross amount if not provided"""
         if self.gross_amount is None:
             self.gross_amount = round(self.net_amount * (1 + self.tax_rate), 2)
         return self
 
 
+class Expense(ExpenseBase, table=True):
+    pass
+
+
 class Customer(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     company: str
@@ -147,3 +164,68 @@ class Invoice(SQLModel, table=True):
     amount: Numeric
     tax_rate: Numeric
     date: DateFormat
+
+
+class InboxStatus(str, Enum):
+    PENDING: str = "pending"
+    LEASED: str = "leased"
+    DONE: str = "done"
+    FAILED: str = "failed"
+
+
+class InboxJob(SQLModel, table=True):
+    """Accepted webhook message waiting to be processed by a worker"""
+
+    __table_args__ = (UniqueConstraint("message_id", name="unique_inbox_message"),)
+    id: Optional[int] = Field(primary_key=True, default=None)
+    message_id: str
+    phone: str = Field(index=True)
+    payload: str
+    status: InboxStatus = Field(default=InboxStatus.PENDING, index=True)
+    attempts: int = 0
+    available_at: datetime = Field(default_factory=utc_now)
+    lease_owner: Optional[str] = None
+    lease_token: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
+
+
+class ProcessedMessage(SQLModel, table=True):
+    """WhatsApp message id already accepted by the webhook"""
+
+    message_id: str = Field(primary_key=True)
+    seen_at: datetime = Field(default_factory=utc_now, index=True)
+
+
+class OutboundDeadLetter(SQLModel, table=True):
+    """Outbound WhatsApp message that could not be delivered"""
+
+    id: Optional[int] = Field(primary_key=True, default=None)
+    phone_number_id: str
+    url: str
+    payload: str
+    priority: int
+    attempts: int
+    error: str
+    created_at: datetime = Field(default_factory=utc_now)
+
+
+class Transcription(SQLModel, table=True):
+    """Whisper transcription of an audio file, keyed on the file's sha256"""
+
+    sha256: str = Field(primary_key=True)
+    text: str
+    size_bytes: int
+    seconds: float
+    created_at: datetime = Field(default_factory=utc_now, index=True)
+
+
+class TableVersion(SQLModel, table=True):
+    """Counter bumped by every write to a table, so cached query results of all
+    worker processes can tell they are stale"""
+
+    table_name: str = Field(primary_key=True)
+    version: int = 0
+    updated_at: datetime = Field(default_factory=utc_now)
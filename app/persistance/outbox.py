@@ -0,0 +1,48 @@
+"""Dead-letter store for outbound messages that could not be delivered"""
+
+import json
+
+from sqlalchemy import func
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from . import db
+from .models import OutboundDeadLetter
+
+from ..configs.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class DeadLetterStore:
+    def __init__(self, engine: Engine | None = None) -> None:
+        self.engine = engine or db.engine
+
+    def add(
+        self,
+        phone_number_id: str,
+        url: str,
+        payload: dict,
+        priority: int,
+        attempts: int,
+        error: str,
+    ) -> None:
+        try:
+            dead_letter = OutboundDeadLetter(
+                phone_number_id=phone_number_id,
+                url=url,
+                payload=json.dumps(payload, default=str),
+                priority=priority,
+                attempts=attempts,
+                error=error,
+            )
+            with Session(self.engine) as session:
+                session.add(dead_letter)
+                session.commit()
+        except Exception as e:
+            # Last resort, the message is at least in the logs
+            logger.error("Error storing dead letter to %s (%s): %s", url, payload, e)
+
+    def count(self) -> int:
+        with Session(self.engine) as session:
+            return session.exec(select(func.count(OutboundDeadLetter.id))).one()
@@ -0,0 +1,118 @@
+"""Cache of query results, invalidated by writes to the queried table
+
+Every write to a table bumps its counter in the `tableversion` table in the
+same transaction. Cached results are keyed on the query and the version of its
+table when it ran, so once any worker process writes, every process misses
+and runs the query again. Reading the version is a primary key lookup, much
+cheaper than the aggregations most questions need.
+"""
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable
+
+from pydantic import BaseModel
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from . import db
+from .models import TableVersion
+from .utils import utc_now
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import QUERY_CACHE_MAX_SIZE
+from ..infrastructure.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+
+def bump_table_version(session: Session, table_name: str) -> None:
+    """Mark cached results of `table_name` as stale. Call it in the session of
+    the write, so the bump commits or rolls back with it"""
+    statement = (
+        insert(TableVersion)
+        .values(table_name=table_name, version=1, updated_at=utc_now())
+        .on_conflict_do_update(
+            index_elements=["table_name"],
+            set_={"version": TableVersion.version + 1, "updated_at": utc_now()},
+        )
+    )
+    session.exec(statement)
+
+
+class QueryResultCache:
+    """Keeps the results of the `max_size` most recently used queries"""
+
+    def __init__(
+        self, max_size: int = QUERY_CACHE_MAX_SIZE, engine: Engine | None = None
+    ) -> None:
+        self.max_size = max_size
+        self._engine = engine
+        # (table, version, query) -> (result, seconds the query took)
+        self._entries: OrderedDict[tuple, tuple[object, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = REGISTRY.counter("query_cache_hits")
+        self.misses = REGISTRY.counter("query_cache_misses")
+        self.seconds_saved = REGISTRY.counter("query_cache_seconds_saved")
+        self.query_seconds = REGISTRY.histogram("query_seconds")
+        REGISTRY.gauge("query_cache_hit_ratio", callback=self.hit_ratio)
+        REGISTRY.gauge("query_cache_size", callback=lambda: len(self._entries))
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits.value + self.misses.value
+        return round(self.hits.value / lookups, 4) if lookups else 0.0
+
+    @property
+    def engine(self) -> Engine:
+        return self._engine or db.engine
+
+    def clear(self) -> None:
+        """Forget every cached result, e.g. when switching databases"""
+        with self._lock:
+            self._entries.clear()
+
+    def version(self, table_name: str) -> int:
+        with Session(self.engine) as session:
+            version = session.exec(
+                select(TableVersion.version).where(
+                    TableVersion.table_name == table_name
+                )
+            ).first()
+        return version or 0
+
+    def get_or_run(self, table_name: str, query: BaseModel, run: Callable):
+        """The cached result of `query` on `table_name`, or the result of `run`,
+        which is cached unless it is an error message"""
+        key = (
+            table_name,
+            self.version(table_name),
+            json.dumps(query.model_dump(mode="json"), sort_keys=True),
+        )
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+        if cached is not None:
+            result, seconds = cached
+            self.hits.inc()
+            self.seconds_saved.inc(seconds)
+            return result
+
+        self.misses.inc()
+        start = time.monotonic()
+        result = run()
+        seconds = time.monotonic() - start
+        self.query_seconds.observe(seconds)
+        if isinstance(result, str):
+            return result
+        with self._lock:
+            self._entries[key] = (result, seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return result
@@ -0,0 +1,151 @@
+"""Cache of audio transcriptions keyed on the sha256 WhatsApp sends with the media
+
+Forwarded voice notes and webhook retries carry the same sha256, so a hit
+skips both the Graph API download and the Whisper call.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, delete, select
+
+from . import db
+from .models import Transcription
+from .utils import utc_now
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import (
+    TRANSCRIPTION_CACHE_MAX_ROWS,
+    TRANSCRIPTION_CACHE_MAX_SIZE,
+    TRANSCRIPTION_CACHE_TTL_SECONDS,
+)
+from ..infrastructure.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+PRUNE_EVERY = 100
+
+
+class TranscriptionCache:
+    """Keeps the `max_size` most recently used transcriptions in memory and up to
+    `max_rows` in the `transcription` table, each for `ttl_seconds`"""
+
+    def __init__(
+        self,
+        ttl_seconds: int = TRANSCRIPTION_CACHE_TTL_SECONDS,
+        max_size: int = TRANSCRIPTION_CACHE_MAX_SIZE,
+        max_rows: int = TRANSCRIPTION_CACHE_MAX_ROWS,
+        engine: Engine | None = None,
+    ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.engine = engine or db.engine
+        self._entries: OrderedDict[str, tuple[Transcription, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        self.hits = REGISTRY.counter("transcription_cache_hits")
+        self.misses = REGISTRY.counter("transcription_cache_misses")
+        self.bytes_saved = REGISTRY.counter("transcription_cache_bytes_saved")
+        self.seconds_saved = REGISTRY.counter("transcription_cache_seconds_saved")
+        REGISTRY.gauge("transcription_cache_hit_ratio", callback=self.hit_ratio)
+        REGISTRY.gauge(
+            "transcription_cache_memory_size", callback=lambda: len(self._entries)
+        )
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits.value + self.misses.value
+        return round(self.hits.value / lookups, 4) if lookups else 0.0
+
+    def get(self, sha256: str) -> str | None:
+        """Return the cached transcription of the audio file with `sha256`"""
+        entry = self._get_from_memory(sha256) or self._get_from_db(sha256)
+        if entry is None:
+            self.misses.inc()
+            return None
+        self.hits.inc()
+        self.bytes_saved.inc(entry.size_bytes)
+        self.seconds_saved.inc(entry.seconds)
+        return entry.text
+
+    def put(self, sha256: str, text: str, size_bytes: int, seconds: float) -> None:
+        """Remember `text` as the transcription of `size_bytes` of audio that took
+        `seconds` to download and transcribe"""
+        now = utc_now()
+        entry = Transcription(
+            sha256=sha256,
+            text=text,
+            size_bytes=size_bytes,
+            seconds=seconds,
+            created_at=now,
+        )
+        self._put_in_memory(entry)
+        values = entry.model_dump()
+        statement = (
+            insert(Transcription)
+            .values(**values)
+            .on_conflict_do_update(index_elements=["sha256"], set_=values)
+        )
+        try:
+            with Session(self.engine) as session:
+                session.exec(statement)
+                self._puts += 1
+                if self._puts % PRUNE_EVERY == 0:
+                    self._prune(session)
+                session.commit()
+        except Exception as e:
+            # The in-memory entry still serves this process
+            logger.error("Error storing transcription %s: %s", sha256, e)
+
+    def _get_from_memory(self, sha256: str) -> Transcription | None:
+        with self._lock:
+            cached = self._entries.get(sha256)
+            if cached is None:
+                return None
+            entry, expires_at = cached
+            if expires_at <= time.monotonic():
+                del self._entries[sha256]
+                return None
+            self._entries.move_to_end(sha256)
+            return entry
+
+    def _put_in_memory(self, entry: Transcription) -> None:
+        # Rows loaded from the database expire with the time they have left
+        age = (utc_now() - entry.created_at).total_seconds()
+        expires_at = time.monotonic() + self.ttl_seconds - max(age, 0)
+        with self._lock:
+            self._entries[entry.sha256] = (entry, expires_at)
+            self._entries.move_to_end(entry.sha256)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_from_db(self, sha256: str) -> Transcription | None:
+        expired = utc_now() - timedelta(seconds=self.ttl_seconds)
+        with Session(self.engine) as session:
+            entry = session.exec(
+                select(Transcription).where(
+                    Transcription.sha256 == sha256,
+                    Transcription.created_at >= expired,
+                )
+            ).first()
+            if entry is None:
+                return None
+            session.expunge(entry)
+        self._put_in_memory(entry)
+        return entry
+
+    def _prune(self, session: Session) -> None:
+        expired = utc_now() - timedelta(seconds=self.ttl_seconds)
+        session.exec(delete(Transcription).where(Transcription.created_at < expired))
+        newest = (
+            select(Transcription.sha256)
+            .order_by(Transcription.created_at.desc())
+            .limit(self.max_rows)
+        )
+        session.exec(delete(Transcription).where(Transcription.sha256.not_in(newest)))
@@ -0,0 +1,151 @@
+"""Directory of the users allowed to talk to the assistant
+
+Users come from employees that have a role in the `employee` table and from
+the `ALLOWED_USERS_LIST` environment variable, which takes precedence. They
+are indexed by normalized phone number, so a lookup costs the same however
+many users there are. Reloading builds a new index and swaps it in with a
+single assignment, so lookups running meanwhile never see a partial index.
+"""
+
+import os
+import re
+import threading
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from . import db
+from .models import Employee
+
+from ..configs.logging_config import get_logger
+from ..configs.service_configs import USER_DIRECTORY_REFRESH_SECONDS
+from ..infrastructure.metrics import REGISTRY
+from ..schema import User
+
+logger = get_logger(__name__)
+
+NON_DIGITS = re.compile(r"\D")
+
+
+def normalize_phone(phone: str) -> str:
+    """E.164 digits without the leading `+`, the format WhatsApp uses in `from`"""
+    digits = NON_DIGITS.sub("", phone)
+    if digits.startswith("00"):
+        digits = digits[2:]
+    return digits
+
+
+def parse_allowed_users(users_string: str) -> list[dict]:
+    """Parses a delimited string of users into a list of dictionaries."""
+    users = []
+    if not users_string:
+        return users
+    user_entries = users_string.split(";")
+    for user_entry in user_entries:
+        try:
+            id_str, phone, first_name, last_name, role = user_entry.split(",")
+            users.append(
+                {
+                    "id": int(id_str),
+                    "phone": phone,
+                    "first_name": first_name,
+                    "last_name": last_name,
+                    "role": role,
+                }
+            )
+        except ValueError as e:
+            logger.error(f"Skipping invalid user entry: {user_entry}. Error: {e}")
+            continue
+    return users
+
+
+class UserDirectory:
+    def __init__(
+        self,
+        engine: Engine | None = None,
+        allowed_users: str | None = None,
+        refresh_seconds: float = USER_DIRECTORY_REFRESH_SECONDS,
+    ) -> None:
+        self.engine = engine or db.engine
+        self.env_users = parse_allowed_users(
+            os.getenv("ALLOWED_USERS_LIST", "")
+            if allowed_users is None
+            else allowed_users
+        )
+        self.refresh_seconds = refresh_seconds
+        self._by_phone: dict[str, User] | None = None
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self.reloads = REGISTRY.counter("user_directory_reloads")
+        self.reload_errors = REGISTRY.counter("user_directory_reload_errors")
+        REGISTRY.gauge(
+            "user_directory_size", callback=lambda: len(self._by_phone or {})
+        )
+
+    def get(self, phone: str) -> User | None:
+        by_phone = self._by_phone
+        if by_phone is None:
+            by_phone = self.reload()
+        return by_phone.get(normalize_phone(phone))
+
+    def reload(self) -> dict[str, User]:
+        """Rebuild the index and swap it in. If the `employee` table can't be
+        read, the previous index is kept"""
+        with self._load_lock:
+            try:
+                employees = self._load_employees()
+            except Exception as e:
+                self.reload_errors.inc()
+                logger.error("Error loading users from the employee table: %s", e)
+                if self._by_phone is not None:
+                    return self._by_phone
+                employees = []
+            by_phone = {}
+            for user_data in employees + self.env_users:
+                user = User(
+                    **{**user_data, "phone": normalize_phone(user_data["phone"])}
+                )
+                by_phone[user.phone] = user
+            self._by_phone = by_phone
+            self.reloads.inc()
+            logger.info("Loaded %s users", len(by_phone))
+            return by_phone
+
+    def _load_employees(self) -> list[dict]:
+        with Session(self.engine) as session:
+            employees = session.exec(
+                select(Employee).where(Employee.role.is_not(None))
+            ).all()
+        return [
+            {
+                "id": employee.id,
+                "phone": employee.phone,
+                "first_name": employee.first_name,
+                "last_name": employee.last_name,
+                "role": employee.role,
+            }
+            for employee in employees
+        ]
+
+    def start(self) -> None:
+        """Load the users and reload them every `refresh_seconds`"""
+        self.reload()
+        if self._thread or not self.refresh_seconds:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._refresh, name="user-directory", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh(self) -> None:
+        while not self._stop.wait(self.refresh_seconds):
+            self.reload()
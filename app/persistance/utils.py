@@ -1,6 +1,6 @@
 """Database utilities"""
 
-from datetime import datetime, time
+from datetime import datetime, time, timezone
 
 
 def validate_date(date_to_validate):
@@ -33,3 +33,7 @@ def numeric_validator(value_to_validate):
     if isinstance(value_to_validate, float):
         return value_to_validate
     raise ValueError("Value must be a number")
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
@@ -3,7 +3,7 @@
 from typing import List, Optional
 from enum import Enum
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class RoleType(str, Enum):
@@ -12,6 +12,8 @@ class RoleType(str, Enum):
 
 
 class User(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: int
     first_name: str
     last_name: str
@@ -65,6 +67,7 @@ class Value(BaseModel):
     metadata: Metadata
     contacts: Optional[List[Contact]] = None
     messages: Optional[List[Message]] = None
+    statuses: Optional[List[dict]] = None
 
 
 class Change(BaseModel):
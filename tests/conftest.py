@@ -0,0 +1,28 @@
+"""Shared fixtures"""
+
+import os
+
+os.environ.setdefault("ENV", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import pytest
+
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, create_engine
+
+from app.domain.tools.query import result_cache
+from app.persistance import db
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """An empty in-memory database in place of the app's"""
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(db, "engine", engine)
+    result_cache.clear()
+    yield engine
+    result_cache.clear()
+    engine.dispose()
@@ -0,0 +1,72 @@
+import json
+
+from types import SimpleNamespace
+
+from pydantic import BaseModel
+
+from app.domain.agents.base import OpenAIAgent
+from app.domain.tools.base import Tool
+from app.domain.tools.report_tool import report_tool
+
+
+class NoArgs(BaseModel):
+    pass
+
+
+class ScriptedClient:
+    """Returns the given responses in order, in place of OpenAI"""
+
+    def __init__(self, *responses) -> None:
+        self.responses = list(responses)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **_):
+        return self.responses.pop(0)
+
+
+def tool_call(name: str, arguments: dict, call_id: str):
+    return SimpleNamespace(
+        id=call_id,
+        type="function",
+        function=SimpleNamespace(name=name, arguments=json.dumps(arguments)),
+    )
+
+
+def response(*tool_calls):
+    message = SimpleNamespace(
+        role="assistant", content=None, tool_calls=list(tool_calls)
+    )
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def agent(client: ScriptedClient) -> OpenAIAgent:
+    lookup = Tool(
+        name="lookup_tool",
+        model=NoArgs,
+        function=lambda: "42 expenses",
+        read_only=True,
+    )
+    save = Tool(name="save_tool", model=NoArgs, function=lambda: "saved")
+    return OpenAIAgent(tools=[lookup, save, report_tool], client=client, verbose=False)
+
+
+def test_report_waits_for_results_of_reads_in_the_same_step():
+    client = ScriptedClient(
+        response(
+            tool_call("lookup_tool", {}, "1"),
+            tool_call("report_tool", {"report": "You have 3 expenses"}, "2"),
+        ),
+        response(tool_call("report_tool", {"report": "You have 42 expenses"}, "3")),
+    )
+    assert agent(client).run("How many expenses?") == "You have 42 expenses"
+    assert not client.responses
+
+
+def test_report_finishes_with_writes_in_the_same_step():
+    client = ScriptedClient(
+        response(
+            tool_call("save_tool", {}, "1"),
+            tool_call("report_tool", {"report": "Saved it"}, "2"),
+        )
+    )
+    assert agent(client).run("Save it") == "Saved it"
@@ -0,0 +1,46 @@
+"""Tests of the Graph API client's retries"""
+
+import httpx
+import pytest
+
+from app.infrastructure.http_client import GraphAPIClient
+
+
+def client_with(*outcomes) -> tuple[GraphAPIClient, list[httpx.Request]]:
+    """A client whose requests raise or answer with `outcomes` in turn"""
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        outcome = outcomes[len(requests) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome)
+
+    client = GraphAPIClient("key", max_retries=2, backoff=0)
+    client._client = httpx.Client(
+        base_url="https://graph", transport=httpx.MockTransport(handler)
+    )
+    return client, requests
+
+
+def test_post_is_not_retried_after_read_timeout():
+    client, requests = client_with(httpx.ReadTimeout("timeout"), 200)
+    with pytest.raises(httpx.ReadTimeout):
+        client.post("/messages", json={})
+    assert len(requests) == 1
+
+
+@pytest.mark.parametrize(
+    "outcome", [httpx.ConnectError("refused"), httpx.ConnectTimeout("timeout"), 503]
+)
+def test_post_is_retried_when_not_delivered(outcome):
+    client, requests = client_with(outcome, 200)
+    assert client.post("/messages", json={}).status_code == 200
+    assert len(requests) == 2
+
+
+def test_get_is_retried_after_read_timeout():
+    client, requests = client_with(httpx.ReadTimeout("timeout"), 200)
+    assert client.get("/media").status_code == 200
+    assert len(requests) == 2
@@ -0,0 +1,38 @@
+"""Tests of the durable inbox"""
+
+from sqlmodel import Session, select
+
+from app.persistance.inbox import Inbox
+from app.persistance.models import InboxJob, InboxStatus
+
+
+def finish(inbox: Inbox, message_id: str, done: bool = True) -> None:
+    inbox.enqueue(message_id, phone="123", payload="{}")
+    (job,) = inbox.claim("worker")
+    if done:
+        inbox.complete(job)
+    else:
+        inbox.fail(job, "error", retry=False)
+
+
+def statuses(engine) -> list[InboxStatus]:
+    with Session(engine) as session:
+        return list(session.exec(select(InboxJob.status).order_by(InboxJob.id)).all())
+
+
+def test_prune_deletes_finished_jobs_past_retention(engine):
+    inbox = Inbox(engine, retention_seconds=0)
+    finish(inbox, "done")
+    finish(inbox, "failed", done=False)
+    inbox.enqueue("pending", phone="456", payload="{}")
+
+    assert inbox.prune() == 2
+    assert statuses(engine) == [InboxStatus.PENDING]
+
+
+def test_prune_keeps_finished_jobs_within_retention(engine):
+    inbox = Inbox(engine, retention_seconds=3600)
+    finish(inbox, "done")
+
+    assert inbox.prune() == 0
+    assert statuses(engine) == [InboxStatus.DONE]
@@ -0,0 +1,43 @@
+"""Tests of the outbound message scheduler"""
+
+import time
+
+from types import SimpleNamespace
+
+from sqlmodel import Session, select
+
+from app.infrastructure.outbound import OutboundScheduler
+from app.persistance.models import OutboundDeadLetter
+from app.persistance.outbox import DeadLetterStore
+
+
+class BrokenClient:
+    """Fails the first post with an unexpected error, then succeeds"""
+
+    def __init__(self) -> None:
+        self.posts = 0
+
+    def post(self, url, json):
+        self.posts += 1
+        if self.posts == 1:
+            raise RuntimeError("boom")
+        return SimpleNamespace(is_success=True, text="ok")
+
+
+def test_unexpected_error_dead_letters_and_keeps_sending(engine):
+    client = BrokenClient()
+    scheduler = OutboundScheduler(client, DeadLetterStore(engine), senders=1)
+    scheduler.start()
+    scheduler.enqueue("1", "https://graph/messages", {"text": "first"})
+    scheduler.enqueue("1", "https://graph/messages", {"text": "second"})
+
+    deadline = time.monotonic() + 5
+    while client.posts < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.stop()
+
+    assert client.posts == 2
+    with Session(engine) as session:
+        (dead_letter,) = session.exec(select(OutboundDeadLetter)).all()
+    assert "boom" in dead_letter.error
+    assert dead_letter.attempts == 1
@@ -0,0 +1,30 @@
+from datetime import datetime, timezone
+
+from app.domain.tools.add import add_row_to_table
+from app.domain.tools.query import query_data_function
+from app.persistance.models import Expense
+
+
+def count_expenses() -> str:
+    result = query_data_function(table_name="expense", columns=["COUNT(*)"])
+    assert result.success
+    return result.content.splitlines()[-1]
+
+
+def test_count_of_empty_table(engine):
+    assert count_expenses() == "0"
+
+
+def test_count_of_table_with_rows(engine):
+    assert count_expenses() == "0"
+    for i in range(3):
+        add_row_to_table(
+            Expense(
+                description=f"receipt {i}",
+                net_amount=10,
+                gross_amount=11,
+                tax_rate=0.1,
+                date=datetime(2025, 1, 1, tzinfo=timezone.utc),
+            )
+        )
+    assert count_expenses() == "3"
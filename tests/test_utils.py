@@ -0,0 +1,19 @@
+"""Tests of the domain utilities"""
+
+from pydantic import BaseModel
+
+from app.domain.utils import orm_model_to_string
+
+
+def test_model_description_follows_retyped_and_renamed_fields():
+    class Item(BaseModel):
+        name: str
+        price: int
+
+    assert orm_model_to_string(Item) == "name = <str>, price = <int>"
+
+    Item.__annotations__["price"] = float
+    assert orm_model_to_string(Item) == "name = <str>, price = <float>"
+
+    Item.__annotations__["cost"] = Item.__annotations__.pop("price")
+    assert orm_model_to_string(Item) == "name = <str>, cost = <float>"